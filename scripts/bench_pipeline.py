@@ -0,0 +1,479 @@
+'''
+End-to-end benchmark for the chat pipeline
+
+Feeds synthetic pytchat-like messages through ChatWorker -> PluginManager -> MainWindow
+using an offscreen Qt platform, then reports:
+- msgs/sec rendered
+- p50/p99 fetch-to-render latency
+- p50/p99 plugin dispatch latency (fetch to the start of `event_message(s)`), per plugin
+- peak RSS and CPU time
+
+With `--streams N` the messages are split between N streams, merged into one chat
+like co-streams are (see `[Backend.sources]`).
+
+`--source replay` reads the messages from replay files, which never wait. `--source pytchat`
+runs the real pytchat client against a stand-in for YouTube's live chat API that takes
+`--latency` seconds to answer each request, like the network does.
+
+Usage: python scripts/bench_pipeline.py [--messages N] [--rate MSGS_PER_MIN] [--streams N] [--source replay|pytchat] [--latency SECONDS] [--plugins real|stub|async|none] [--batch yes|no] [--backend thread|asyncio] [--polling fixed|adaptive] [--pluginmain yes|no] [--trace PATH]
+'''
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import inspect
+import shutil
+import argparse
+import logging
+import tempfile
+import configparser
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SRC = os.path.join(ROOT, "src")
+sys.path.insert(0, SRC)
+
+WORDS = ["hello", "chat", "pog", "lol", "gg", "nice", "stream", "what", "is", "this", ":thumbs_up:", ":fire:"]
+
+STUB_PLUGIN = '''
+from pluginsdk import PluginInterface
+
+class {cls}(PluginInterface):
+    def event_load(self, logger):
+        self.logger = logger
+        self.seen = 0
+
+    def event_message(self, m):
+        if m.message.startswith("{prefix}"):
+            self.seen += 1
+
+    def event_messages(self, messages):
+        for m in messages:
+            if m.message.startswith("{prefix}"):
+                self.seen += 1
+
+    def event_kill(self):
+        pass
+
+    def event_notify(self, source, data):
+        pass
+
+    def event_main(self, t, loop_wait):
+        pass
+
+    def configure(self, config):
+        pass
+'''
+
+# Like the stubs, but pretends every poll needs a network request
+ASYNC_STUB_PLUGIN = '''
+import asyncio
+from pluginsdk import PluginInterface
+
+class {cls}(PluginInterface):
+    max_concurrency = 16
+
+    def event_load(self, logger):
+        self.logger = logger
+        self.seen = 0
+
+    def event_message(self, m):
+        pass
+
+    async def event_messages(self, messages):
+        await asyncio.sleep(0.005)
+        for m in messages:
+            if m.message.startswith("{prefix}"):
+                self.seen += 1
+
+    def event_kill(self):
+        pass
+
+    def event_notify(self, source, data):
+        pass
+
+    def event_main(self, t, loop_wait):
+        pass
+
+    def configure(self, config):
+        pass
+'''
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return float("nan")  # Windows
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+def make_messages(paths, count, rate):
+    '''
+    Write `count` synthetic messages, dealt out between the JSONL replay files in `paths`
+    `rate` is in messages per minute, 0 puts every message at the same timestamp
+    '''
+    rng = random.Random(1234)
+    step_ms = 60000 / rate if rate > 0 else 0
+    files = [open(path, "w", encoding="utf-8") for path in paths]
+    try:
+        for i in range(count):
+            f = files[i % len(files)]
+            roll = rng.random()
+            if roll < 0.05:
+                text = "!tts " + " ".join(rng.choices(WORDS, k=6))
+            elif roll < 0.10:
+                text = "!vote " + rng.choice(["a", "b", "c"])
+            else:
+                text = " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+
+            superchat = rng.random() < 0.02
+            author_id = f"UC{rng.randint(0, 5000):08d}"
+            f.write(json.dumps({
+                "type": "superChat" if superchat else "textMessage",
+                "id": str(i),
+                "message": text,
+                "timestamp": int(i * step_ms),
+                "amountValue": 5.0 if superchat else 0.0,
+                "amountString": "$5.00" if superchat else "",
+                "currency": "USD" if superchat else "",
+                "author": {"name": f"viewer{author_id[-4:]}", "channelId": author_id},
+            }) + "\n")
+    finally:
+        for f in files:
+            f.close()
+
+class StandInLiveChat:
+    '''
+    Answers pytchat's requests for one stream like YouTube's live chat API does. Each request
+    gets the messages from `path` that are due by now (by their `timestamp`, from the first request)
+    '''
+    def __init__(self, path, latency):
+        with open(path, "r", encoding="utf-8") as f:
+            self.records = [json.loads(line) for line in f if line.strip()]
+        self.latency = latency
+        self.position = 0
+        self.started = None
+        self.started_ns = None
+        self.requests = 0  # Chat requests, not counting the first page
+
+    def posted(self):
+        '''
+        Message ID -> when it was posted to the chat (perf_counter_ns), for the messages that were
+        '''
+        if self.started_ns is None:
+            return {}
+        return {r["id"]: self.started_ns + int(r["timestamp"] * 1e6) for r in self.records}
+
+    def action(self, record):
+        author = record["author"]
+        renderer = {
+            "id": record["id"],
+            "timestampUsec": str(int((self.started + record["timestamp"] / 1000) * 1e6)),
+            "message": {"runs": [{"text": record["message"]}]},
+            "authorName": {"simpleText": author["name"]},
+            "authorPhoto": {"thumbnails": [{"url": ""}, {"url": ""}]},
+            "authorExternalChannelId": author["channelId"],
+        }
+        if record["type"] == "superChat":
+            renderer["purchaseAmountText"] = {"simpleText": record["amountString"]}
+            return {"addChatItemAction": {"item": {"liveChatPaidMessageRenderer": renderer}}}
+        return {"addChatItemAction": {"item": {"liveChatTextMessageRenderer": renderer}}}
+
+    def handle(self, request):
+        import httpx
+
+        time.sleep(self.latency)
+        if request.method == "GET":
+            # The embed page pytchat finds the channel ID in
+            return httpx.Response(200, text='\\"channelId\\":\\"UC4R8DWoMoI7CAwX8_LjQHig\\"')
+
+        if self.started is None:
+            self.started = time.time()
+            self.started_ns = time.perf_counter_ns()
+        self.requests += 1
+        elapsed_ms = (time.time() - self.started) * 1000
+        end = self.position
+        while end < len(self.records) and self.records[end]["timestamp"] <= elapsed_ms:
+            end += 1
+        actions = [self.action(r) for r in self.records[self.position:end]]
+        self.position = max(self.position, end)
+
+        return httpx.Response(200, json={"continuationContents": {"liveChatContinuation": {
+            "continuations": [{"timedContinuationData": {"continuation": "next", "timeoutMs": 5000}}],
+            "actions": actions,
+        }}})
+
+def use_stand_in_youtube(replay_paths, video_ids, latency):
+    '''
+    Make pytchat talk to a stand-in for each stream instead of YouTube
+    '''
+    import httpx
+    import pytchat
+
+    stand_ins = {video_id: StandInLiveChat(path, latency) for video_id, path in zip(video_ids, replay_paths)}
+    create = pytchat.create
+    def create_stand_in(video_id, **kwargs):
+        transport = httpx.MockTransport(stand_ins[video_id].handle)
+        return create(video_id, client=httpx.Client(transport=transport), interruptable=False, **kwargs)
+    pytchat.create = create_stand_in
+    return stand_ins
+
+def make_plugins(plugin_dir, mode):
+    '''
+    Create the plugin directory the benchmark loads from
+    '''
+    os.makedirs(plugin_dir)
+    if mode == "real":
+        for name in ("tts", "votes"):
+            shutil.copytree(os.path.join(SRC, "plugins", name), os.path.join(plugin_dir, name))
+
+        # Never actually speak during a benchmark
+        fake = types.ModuleType("pyttsx3")
+        fake.init = lambda *a, **k: types.SimpleNamespace(say=lambda text: None, runAndWait=lambda: None, stop=lambda: None)
+        sys.modules["pyttsx3"] = fake
+
+    elif mode in ("stub", "async"):
+        # The stubs take whole polls with `event_messages`, the real plugins don't
+        template = STUB_PLUGIN if mode == "stub" else ASYNC_STUB_PLUGIN
+        for name, cls, prefix in (("tts", "StubTTS", "!tts"), ("votes", "StubVotes", "!vote")):
+            os.makedirs(os.path.join(plugin_dir, name))
+            with open(os.path.join(plugin_dir, name, "main.py"), "w") as f:
+                f.write(template.format(cls=cls, prefix=prefix))
+            with open(os.path.join(plugin_dir, name, "config.json"), "w") as f:
+                f.write("{}")
+
+def make_config(workdir, replay_paths, video_ids, source, plugin_dir, rate, batch, backend, polling, pluginmain, trace):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "res", "defaultconfig.ini"))
+
+    config["Backend"]["chat_source"] = source
+    config["Backend"]["replay_path"] = replay_paths[0]
+    config["Backend"]["replay_speed"] = "1" if rate > 0 else "0"
+    config["Backend"]["backend_mode"] = backend
+    config["Backend"]["polling"] = polling
+    if source == "replay":
+        # Replays never wait, so poll as often as possible. pytchat keeps the config's timing
+        config["Backend"]["loop_wait_ns"] = "1000"
+        config["Backend"]["loop_wait_min_ns"] = "1000"
+        streams = replay_paths
+    else:
+        streams = video_ids
+    config["Backend.sources"] = {f"stream{i}": stream for i, stream in enumerate(streams[1:], 1)}
+    config["Frontend"]["terminal_echo"] = "no"
+    config["Frontend"]["verbose"] = "no"
+    config["Frontend"]["batch_messages"] = batch
+
+    # The message ID goes at the front so rendered text can be matched to when it was fetched
+    for name in config["Frontend.messageTemplates"]:
+        config["Frontend.messageTemplates"][name] = "{msg.id}|" + config["Frontend.messageTemplates"][name]
+
+    config["Plugins"]["enable_pluginmain"] = pluginmain
+    config["Plugins.Paths"]["plugindir"] = plugin_dir
+    config["Plugins.enable"]["votes"] = "yes"
+    config["Plugins"]["discovery_cache"] = os.path.join(workdir, "discovery.json")
+
+    if trace is not None:
+        config["Tracing"]["enabled"] = "yes"
+        config["Tracing"]["sample_rate"] = "0.05"
+        config["Tracing"]["output"] = os.path.abspath(trace)
+
+    path = os.path.join(workdir, "bench.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="streamutils-bench-")
+    replay_paths = [os.path.join(workdir, f"chat{i}.jsonl") for i in range(args.streams)]
+    video_ids = [f"benchstrm{i:02d}" for i in range(args.streams)]  # 11 characters, like YouTube's
+    plugin_dir = os.path.join(workdir, "plugins")
+
+    make_messages(replay_paths, args.messages, args.rate)
+    make_plugins(plugin_dir, args.plugins)
+    config_path = make_config(workdir, replay_paths, video_ids, args.source, plugin_dir, args.rate, args.batch, args.backend, args.polling, args.pluginmain, args.trace)
+    stand_ins = {}
+    if args.source == "pytchat":
+        stand_ins = use_stand_in_youtube(replay_paths, video_ids, args.latency)
+
+    import ttsfront
+    config = ttsfront.load_config(config_path)
+    logging.disable(logging.WARNING)  # The plugin manager warns a lot under load, keep the report readable
+    from PyQt5.QtCore import QTimer
+
+    fetched = {}
+    rendered = {}
+    dispatched = {}
+
+    def stamp_rendered(txts):
+        now = time.perf_counter_ns()
+        for txt in txts:
+            msg_id, sep, _ = txt.partition("|")
+            if sep and msg_id.isdigit():
+                rendered[msg_id] = now
+
+    class BenchWindow(ttsfront.MainWindow):
+        def append_message(self, txt):
+            super().append_message(txt)
+            stamp_rendered((txt,))
+
+        def append_messages(self, txts, fetched_at=None, trace=None):
+            super().append_messages(txts, fetched_at, trace)
+            stamp_rendered(txts)
+
+    app = ttsfront.get_app()
+    worker = ttsfront.ChatWorker(video_ids[0] if args.source == "pytchat" else "bench", config)
+
+    # Stamp every message with the time it was fetched, from each stream when they're merged
+    for source in getattr(worker.chat, "sources", {"youtube": worker.chat}).values():
+        def timed_get_items(get_items=source.get_items):
+            items = get_items()
+            now = time.perf_counter_ns()
+            for c in items:
+                fetched[c.id] = now
+            return items
+        source.get_items = timed_get_items
+
+    # Count messages once they're in the plugins' queues
+    notified = [0]
+    message_notify = worker.message_notify
+    def counted_message_notify(messages):
+        message_notify(messages)
+        notified[0] += len(messages)
+    worker.message_notify = counted_message_notify
+
+    # Wrap every plugin's event_message once they are loaded, but before they get messages
+    manager = worker.plugin_manager
+    configure_plugins = manager.configure_plugins
+    def timed_configure_plugins():
+        for name, plugin in manager.plugins.items():
+            latencies = dispatched.setdefault(os.path.basename(os.path.dirname(name)), [])
+            def event_message(self, m, original=plugin.event_message, latencies=latencies):
+                latencies.append(time.perf_counter_ns() - fetched[m.id])
+                return original(m)
+            plugin.event_message = types.MethodType(event_message, plugin)
+
+            def event_messages(self, messages, original=plugin.event_messages, latencies=latencies):
+                now = time.perf_counter_ns()
+                latencies.extend(now - fetched[m.id] for m in messages)
+                return original(messages)
+
+            if inspect.iscoroutinefunction(plugin.event_messages):
+                # Async plugins have to stay async
+                async def event_messages(self, messages, timed=event_messages):
+                    await timed(self, messages)
+            plugin.event_messages = types.MethodType(event_messages, plugin)
+        configure_plugins()
+    manager.configure_plugins = timed_configure_plugins
+
+    window = BenchWindow(worker, config)
+    started = time.perf_counter()
+
+    def check_done():
+        # Finished once everything is on screen and every plugin has caught up
+        idle = not any(queue.scheduled for queue in manager.queues.values()) and not any(manager.running_tasks.values())
+        done = len(rendered) >= args.messages and notified[0] >= args.messages and idle
+        if done or time.perf_counter() - started > args.timeout:
+            window.close()
+            app.quit()
+
+    timer = QTimer()
+    timer.timeout.connect(check_done)
+    timer.start(50)
+    app.exec_()
+
+    latencies = [rendered[i] - fetched[i] for i in rendered if i in fetched]
+    posted = {}
+    for stand_in in stand_ins.values():
+        posted.update(stand_in.posted())
+    waited = [fetched[i] - posted[i] for i in fetched if i in posted]
+    requests = sum(stand_in.requests for stand_in in stand_ins.values())
+    first = min(fetched.values(), default=0)
+    last = max(rendered.values(), default=0)
+    elapsed = (last - first) / 1e9 if rendered else float("nan")
+
+    result = {
+        "messages": args.messages,
+        "rendered": len(rendered),
+        "rate_per_min": args.rate,
+        "streams": args.streams,
+        "source": args.source,
+        "latency": args.latency,
+        "plugins": args.plugins,
+        "batch": args.batch,
+        "backend": args.backend,
+        "polling": args.polling,
+        "pluginmain": args.pluginmain,
+        "final_loop_wait": worker.loop_wait,
+        "msgs_per_sec": len(rendered) / elapsed if elapsed > 0 else float("nan"),
+        "render_latency_p50_ms": percentile(latencies, 50) / 1e6,
+        "render_latency_p99_ms": percentile(latencies, 99) / 1e6,
+        "fetch_wait_p50_ms": percentile(waited, 50) / 1e6 if waited else None,
+        "fetch_wait_p99_ms": percentile(waited, 99) / 1e6 if waited else None,
+        "requests_per_sec": requests / args.streams / elapsed if stand_ins and elapsed > 0 else None,
+        "dispatch_latency_ms": {
+            name: {"p50": percentile(v, 50) / 1e6, "p99": percentile(v, 99) / 1e6, "count": len(v)}
+            for name, v in dispatched.items()
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "cpu_seconds": cpu_seconds(),
+    }
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def report(result):
+    print(f"Rendered {result['rendered']}/{result['messages']} messages (rate={result['rate_per_min'] or 'max'}/min, streams={result['streams']}, source={result['source']}, plugins={result['plugins']}, batch={result['batch']}, backend={result['backend']}, polling={result['polling']}, pluginmain={result['pluginmain']})")
+    print(f"  throughput:           {result['msgs_per_sec']:10.1f} msgs/sec")
+    print(f"  fetch-to-render p50:  {result['render_latency_p50_ms']:10.2f} ms")
+    print(f"  fetch-to-render p99:  {result['render_latency_p99_ms']:10.2f} ms")
+    if result["fetch_wait_p50_ms"] is not None:
+        # How long messages sat in the chat before a poll picked them up
+        print(f"  post-to-fetch p50:    {result['fetch_wait_p50_ms']:10.2f} ms")
+        print(f"  post-to-fetch p99:    {result['fetch_wait_p99_ms']:10.2f} ms")
+        print(f"  requests per stream:  {result['requests_per_sec']:10.2f} /sec")
+    for name, d in result["dispatch_latency_ms"].items():
+        print(f"  dispatch {name:12s} p50={d['p50']:.2f} ms p99={d['p99']:.2f} ms ({d['count']} events)")
+    print(f"  final loop wait:      {result['final_loop_wait']:10d}")
+    print(f"  peak RSS:             {result['peak_rss_mb']:10.1f} MB")
+    print(f"  CPU time:             {result['cpu_seconds']:10.2f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the chat pipeline")
+    parser.add_argument("--messages", type=int, default=5000, help="number of messages to replay")
+    parser.add_argument("--rate", type=float, default=0, help="messages per minute, 0 = as fast as possible")
+    parser.add_argument("--streams", type=int, default=1, help="split the messages between this many merged chat sources")
+    parser.add_argument("--source", choices=["replay", "pytchat"], default="replay", help="replay files, or pytchat against a stand-in YouTube")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the stand-in YouTube takes to answer, with --source pytchat")
+    parser.add_argument("--plugins", choices=["real", "stub", "async", "none"], default="real", help="which plugins to load")
+    parser.add_argument("--batch", choices=["yes", "no"], default="yes", help="use batched message delivery to the window")
+    parser.add_argument("--backend", choices=["thread", "asyncio"], default="thread", help="[Backend] backend_mode to use")
+    parser.add_argument("--polling", choices=["fixed", "adaptive"], default="fixed", help="[Backend] polling to use")
+    parser.add_argument("--pluginmain", choices=["yes", "no"], default="no", help="[Plugins] enable_pluginmain to use")
+    parser.add_argument("--trace", type=str, default=None, help="write a Chrome trace of 5%% of messages to this file")
+    parser.add_argument("--timeout", type=float, default=120, help="give up after this many seconds")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+    if args.source == "pytchat" and args.backend == "asyncio":
+        parser.error("--source pytchat only works with --backend thread, the stand-in can't serve pytchat's asyncio client")
+
+    result = run(args)
+    report(result)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,188 @@
+'''
+Startup benchmark for the chat overlay
+
+Starts ttsfront in a fresh process for each startup mode, using the offscreen Qt platform,
+and reports:
+- time-to-first-frame, from starting the process to the first window being painted
+- how long importing ttsfront took
+- which heavy dependencies (selenium, pytchat, emoji) were loaded by the first frame
+
+Chat comes from a replay file and no plugins are loaded, so only startup itself is measured.
+autofetch checks a local stand-in for YouTube that always says the channel is live.
+
+Usage: python scripts/bench_startup.py [--modes none,linkui,autofetch] [--runs N] [--source replay|pytchat] [--json PATH]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import statistics
+import configparser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SRC = os.path.join(ROOT, "src")
+
+MODES = ("none", "linkui", "autofetch")
+HEAVY_MODULES = ("selenium", "pytchat", "emoji")
+
+class StandInYouTube(BaseHTTPRequestHandler):
+    '''
+    Answers /channel/<id>/live like YouTube does while the channel is live
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'<html><head><link rel="canonical" href="https://www.youtube.com/watch?v=jfKfPfyJRdk"></head></html>'
+        self.send_response(200 if self.path.endswith("/live") else 404)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_config(workdir, mode, source, base_url):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "res", "defaultconfig.ini"))
+
+    replay_path = os.path.join(workdir, "chat.jsonl")
+    with open(replay_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "textMessage", "id": "0", "message": "hello", "timestamp": 0, "author": {"name": "viewer", "channelId": "UC0"}}) + "\n")
+
+    plugin_dir = os.path.join(workdir, "plugins")
+    os.makedirs(plugin_dir, exist_ok=True)
+
+    config["Startup"]["startup_mode"] = mode
+    config["Startup"]["channelid"] = "UC4R8DWoMoI7CAwX8_LjQHig"
+    config["Startup"]["autofetch_base_url"] = base_url
+    config["Startup"]["autofetch_cache"] = ""  # Check every time, that's what's being measured
+    config["Startup"]["autofetch_selenium"] = "no"
+    config["Backend"]["chat_source"] = source
+    config["Backend"]["replay_path"] = replay_path
+    config["Frontend"]["terminal_echo"] = "no"
+    config["Plugins.Paths"]["plugindir"] = plugin_dir
+    config["Plugins"]["discovery_cache"] = os.path.join(workdir, "discovery.json")
+
+    path = os.path.join(workdir, f"startup-{mode}.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+def child(config_path):
+    '''
+    Runs in the benchmarked process. Prints one line of JSON when the first window is painted
+    '''
+    sys.path.insert(0, SRC)
+
+    import_started = time.monotonic()
+    import ttsfront
+    import_finished = time.monotonic()
+
+    from PyQt5.QtCore import QObject, QEvent
+
+    class FirstFrame(QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Paint:
+                # After a newline, the console title escape code has no newline of it's own
+                print("\n" + json.dumps({
+                    "first_frame": time.monotonic(),
+                    "import_seconds": import_finished - import_started,
+                    "loaded": [name for name in HEAVY_MODULES if name in sys.modules],
+                }), flush=True)
+                os._exit(0)  # The worker thread and any dialog are still running, don't wait for them
+            return False
+
+    # Every startup mode gets it's QApplication from here
+    get_app = ttsfront.get_app
+    first_frame = FirstFrame()
+    def watched_get_app():
+        app = get_app()
+        app.installEventFilter(first_frame)
+        return app
+    ttsfront.get_app = watched_get_app
+
+    ttsfront.main(["bench", "-C", config_path, "--log_level", "40", "--quiet"])
+
+def run_once(config_path, timeout):
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    started = time.monotonic()  # Shared by every process, so it can be compared with the child's
+    try:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", config_path],
+            env=env, capture_output=True, text=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        return {"error": f"no frame after {timeout} seconds"}
+
+    for line in proc.stdout.splitlines():
+        if line.startswith("{"):
+            result = json.loads(line)
+            result["first_frame_seconds"] = result.pop("first_frame") - started
+            return result
+
+    lines = [line for line in proc.stderr.splitlines() if line.strip()]
+    return {"error": lines[-1] if lines else f"exited with code {proc.returncode} before the first frame"}
+
+def run(args):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInYouTube)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="streamutils-startup-") as workdir:
+        for mode in args.modes:
+            config_path = make_config(workdir, mode, args.source, base_url)
+            runs = [run_once(config_path, args.timeout) for _ in range(args.runs)]
+            ok = [r for r in runs if "error" not in r]
+            if not ok:
+                results[mode] = {"error": runs[-1]["error"]}
+                continue
+
+            results[mode] = {
+                "runs": len(ok),
+                "first_frame_ms": statistics.median(r["first_frame_seconds"] for r in ok) * 1000,
+                "first_frame_min_ms": min(r["first_frame_seconds"] for r in ok) * 1000,
+                "import_ms": statistics.median(r["import_seconds"] for r in ok) * 1000,
+                "loaded": ok[-1]["loaded"],
+            }
+
+    server.shutdown()
+    return results
+
+def report(results, source):
+    print(f"Time to first frame (source={source})")
+    for mode, r in results.items():
+        if "error" in r:
+            print(f"  {mode:10s} failed: {r['error']}")
+            continue
+        loaded = ", ".join(r["loaded"]) or "nothing heavy"
+        print(f"  {mode:10s} median={r['first_frame_ms']:8.1f} ms  min={r['first_frame_min_ms']:8.1f} ms  import ttsfront={r['import_ms']:7.1f} ms  loaded: {loaded}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark startup time for each startup mode")
+    parser.add_argument("--modes", type=lambda s: s.split(","), default=list(MODES), help="comma separated startup modes to measure")
+    parser.add_argument("--runs", type=int, default=5, help="processes to start for each mode")
+    parser.add_argument("--source", choices=["replay", "pytchat"], default="replay", help="[Backend] chat_source to use")
+    parser.add_argument("--timeout", type=float, default=60, help="give up on a process after this many seconds")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child)
+        sys.exit(1)  # Only reached if the window closed without ever being painted
+
+    results = run(args)
+    report(results, args.source)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,40 @@
+'''
+Module for the small JSON caches kept between runs (plugin discovery, autofetch).
+
+Each cache file is `{"version": ..., <key>: data}`. A cache with another version (or one
+that can't be read) is treated as empty, and writes never leave half a file behind.
+'''
+
+import os
+import json
+
+def read(path: str, version: int, key: str, logger, name: str) -> dict:
+    '''
+    Returns the data saved under `key` by `write`, or {} if there's no usable cache.
+    `name` is what the cache is called in log messages
+    '''
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Can't read the {name} {path} ({e})")
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != version:
+        return {}
+    return cache.get(key, {})
+
+def write(path: str, version: int, key: str, data: dict, logger, name: str):
+    '''
+    Save `data` under `key`. Logs a warning if it can't, a cache is never worth crashing for
+    '''
+    try:
+        # Written to a temporary file first so a crash can't leave half a cache
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"version": version, key: data}, f)
+        os.replace(temporary, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Can't write the {name} {path} ({e})")
@@ -0,0 +1,385 @@
+'''
+Module containing chat sources, these are where ChatWorker gets it's messages from.
+
+A chat source only has to hand back a list of pytchat-like message objects every
+time it's polled, so the rest of the pipeline doesn't care if the messages come from
+a live stream or from a file on disk.
+'''
+
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+import concurrent.futures as cf
+import asyncio
+import heapq
+import json
+import time
+import logging
+
+class ChatSource(ABC):
+    '''
+    Base class for every chat source
+    '''
+    # True if `get_items` can block for a while (on the network, etc.)
+    waits = True
+
+    @abstractmethod
+    def get_items(self) -> list:
+        '''
+        Returns a list of every message that arrived since the last call.
+        Returns an empty list when nothing arrived
+        '''
+        pass
+
+    async def get_items_async(self) -> list:
+        '''
+        The same as `get_items`, for the asyncio backend.
+        By default `get_items` is run on a thread so it can't hold up the event loop
+        '''
+        return await asyncio.to_thread(self.get_items)
+
+    @abstractmethod
+    def is_alive(self) -> bool:
+        '''
+        Returns True while the source can still produce messages
+        '''
+        pass
+
+    def terminate(self):
+        '''
+        Stop the source and release anything it holds, does nothing by default
+        '''
+        pass
+
+class PytchatSource(ChatSource):
+    '''
+    Chat source for a live YouTube stream, using pytchat.
+    Each poll is one request to YouTube. The messages are handed back as soon as they're
+    fetched, pytchat's `sync_items` would spread them out over the poll (and wait at
+    least a second) but ChatWorker decides how often to poll
+    '''
+    def __init__(self, video_id: str):
+        import pytchat  # Slow to import, so only when it's used
+
+        self.video_id = video_id
+        self.chat = pytchat.create(video_id=self.video_id)
+
+    def get_items(self) -> list:
+        if not self.chat.is_alive():
+            return []  # Stopped, or the stream ended
+
+        data = self.chat.get()
+        if not data:
+            return []  # Stopped while we were fetching, pytchat hands back a plain list then
+
+        return data.items
+
+    def is_alive(self) -> bool:
+        return self.chat.is_alive()
+
+    def terminate(self):
+        self.chat.terminate()
+
+class AsyncPytchatSource(ChatSource):
+    '''
+    Chat source for a live YouTube stream, using pytchat's asyncio client.
+    Only works with `[Backend] backend_mode = asyncio`, the client has to be created
+    inside the running event loop so that's done on the first poll
+    '''
+    def __init__(self, video_id: str):
+        self.video_id = video_id
+        self.chat = None
+
+    def get_items(self) -> list:
+        raise RuntimeError("AsyncPytchatSource can only be polled from the event loop, use get_items_async")
+
+    async def get_items_async(self) -> list:
+        if self.chat is None:
+            import pytchat  # Slow to import, so only when it's used
+
+            # interruptable=False, we aren't on the main thread so it can't install a SIGINT handler
+            self.chat = pytchat.LiveChatAsync(self.video_id, interruptable=False)
+
+        data = await self.chat.get()
+        if not data:
+            return []  # The chat has finished
+
+        return data.items  # Not `async_items`, that spreads them out over a second or more
+
+    def is_alive(self) -> bool:
+        return self.chat is None or self.chat.is_alive()
+
+    def terminate(self):
+        if self.chat is not None:
+            self.chat.terminate()
+
+def message_from_record(record: dict):
+    '''
+    Turn a dictionary of message fields (the same names pytchat uses) into an object
+    that looks like a pytchat message. Missing fields are filled with defaults
+    '''
+    author = record.get("author", {})
+    return SimpleNamespace(
+        type=record.get("type", "textMessage"),
+        id=record.get("id", ""),
+        message=record.get("message", ""),
+        messageEx=record.get("messageEx", []),
+        timestamp=record.get("timestamp", 0),
+        datetime=record.get("datetime", ""),
+        elapsedTime=record.get("elapsedTime", ""),
+        amountValue=record.get("amountValue", 0.0),
+        amountString=record.get("amountString", ""),
+        currency=record.get("currency", ""),
+        bgColor=record.get("bgColor", 0),
+        author=SimpleNamespace(
+            name=author.get("name", ""),
+            channelId=author.get("channelId", ""),
+            channelUrl=author.get("channelUrl", ""),
+            imageUrl=author.get("imageUrl", ""),
+            badgeUrl=author.get("badgeUrl", ""),
+            isVerified=author.get("isVerified", False),
+            isChatOwner=author.get("isChatOwner", False),
+            isChatModerator=author.get("isChatModerator", False),
+            isChatSponsor=author.get("isChatSponsor", False),
+        ),
+    )
+
+def record_from_message(c) -> dict:
+    '''
+    The opposite of `message_from_record`, turns a pytchat message into a dictionary
+    that can be written as one line of a replay file
+    '''
+    return {
+        "type": c.type,
+        "id": c.id,
+        "message": c.message,
+        "messageEx": c.messageEx,
+        "timestamp": c.timestamp,
+        "datetime": c.datetime,
+        "elapsedTime": c.elapsedTime,
+        "amountValue": c.amountValue,
+        "amountString": c.amountString,
+        "currency": c.currency,
+        "bgColor": c.bgColor,
+        "author": {
+            "name": c.author.name,
+            "channelId": c.author.channelId,
+            "channelUrl": c.author.channelUrl,
+            "imageUrl": c.author.imageUrl,
+            "badgeUrl": c.author.badgeUrl,
+            "isVerified": c.author.isVerified,
+            "isChatOwner": c.author.isChatOwner,
+            "isChatModerator": c.author.isChatModerator,
+            "isChatSponsor": c.author.isChatSponsor,
+        },
+    }
+
+class ReplaySource(ChatSource):
+    '''
+    Chat source that replays recorded chat from a JSONL file, one message per line.
+
+    `speed` controls the timing:
+    - 1.0 replays at the original timing (using the `timestamp` field, in milliseconds)
+    - N replays N times faster than the original
+    - 0 replays as fast as possible, everything is returned on the first poll
+    '''
+    waits = False
+
+    def __init__(self, path: str, speed: float = 1.0, loop: bool = False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.logger = logging.getLogger("chatsource")
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            self.records = [json.loads(line) for line in f if line.strip()]
+
+        self.records.sort(key=lambda r: r.get("timestamp", 0))
+        self.logger.info(f"Loaded {len(self.records)} recorded messages from {self.path} (speed={self.speed})")
+
+        self.rewind()
+
+    def rewind(self):
+        '''
+        Start the replay again from the first message
+        '''
+        self.position = 0
+        self.started_at = time.monotonic()
+        self.first_timestamp = self.records[0].get("timestamp", 0) if self.records else 0
+
+    def get_items(self) -> list:
+        if self.position >= len(self.records):
+            if not self.loop or not self.records:
+                return []
+            self.rewind()
+
+        if self.speed <= 0:
+            # As fast as possible, hand back everything that's left
+            end = len(self.records)
+        else:
+            # Convert the real time that has passed into recording time (milliseconds)
+            elapsed = (time.monotonic() - self.started_at) * 1000 * self.speed
+            end = self.position
+            while end < len(self.records) and self.records[end].get("timestamp", 0) - self.first_timestamp <= elapsed:
+                end += 1
+
+        items = [message_from_record(r) for r in self.records[self.position:end]]
+        self.position = end
+        return items
+
+    async def get_items_async(self) -> list:
+        return self.get_items()  # Never waits, no need for a thread
+
+    def is_alive(self) -> bool:
+        return self.loop or self.position < len(self.records)
+
+class MergedSource(ChatSource):
+    '''
+    Chat source that polls several others and merges their messages into one stream,
+    for co-streams and simulcasts shown in one overlay.
+
+    Every message is tagged with the name of the source it came from (it's `platform`),
+    and each poll is merged in timestamp order. A source that fails or finishes is
+    skipped, the others keep going.
+
+    Sources that wait (like pytchat, one request to YouTube per poll) are polled at the
+    same time on their own threads. A poll hands back whatever has arrived, so a slow
+    stream never holds up the others, it's messages come with a later poll
+    '''
+    def __init__(self, sources: dict[str, ChatSource]):
+        # Name -> source, the name is what messages are tagged with
+        self.sources = sources
+        self.finished = set()
+        self.logger = logging.getLogger("chatsource")
+
+        # Name -> the poll of that source that's still running
+        self.polling = {}
+        waiting = sum(1 for source in sources.values() if source.waits)
+        self.executor = cf.ThreadPoolExecutor(max_workers=waiting, thread_name_prefix="chatsource") if waiting else None
+
+    def alive_sources(self):
+        for name, source in self.sources.items():
+            if name in self.finished:
+                continue
+            if not source.is_alive():
+                self.logger.info(f"Chat source `{name}` has finished")
+                self.finished.add(name)
+                continue
+            yield name, source
+
+    def tag(self, name: str, items: list) -> list:
+        for c in items:
+            c.platform = name
+        items.sort(key=timestamp_of)  # Usually already in order, then this is cheap
+        return items
+
+    def merge(self, polls: list) -> list:
+        if len(polls) == 1:
+            return polls[0]
+        return list(heapq.merge(*polls, key=timestamp_of))
+
+    def get_items(self) -> list:
+        polls = []
+        waiting = []
+        for name, source in self.alive_sources():
+            if not source.waits:
+                try:
+                    polls.append(self.tag(name, source.get_items()))
+                except Exception as e:
+                    self.logger.error(f"Can't get chat from source `{name}` ({e!r})")
+                continue
+
+            if name not in self.polling:
+                self.polling[name] = self.executor.submit(source.get_items)
+            waiting.append(name)
+
+        if waiting and not any(polls):
+            # Nothing to hand back yet, wait for whichever source answers first
+            cf.wait([self.polling[name] for name in waiting], return_when=cf.FIRST_COMPLETED)
+
+        for name in waiting:
+            future = self.polling[name]
+            if not future.done():
+                continue  # Still fetching, picked up by a later poll
+
+            del self.polling[name]
+            try:
+                polls.append(self.tag(name, future.result()))
+            except Exception as e:
+                self.logger.error(f"Can't get chat from source `{name}` ({e!r})")
+
+        return self.merge(polls)
+
+    async def get_items_async(self) -> list:
+        names = []
+        pending = []
+        for name, source in self.alive_sources():
+            names.append(name)
+            pending.append(source.get_items_async())
+
+        # Every source is polled at the same time
+        polls = []
+        for name, result in zip(names, await asyncio.gather(*pending, return_exceptions=True)):
+            if isinstance(result, BaseException):
+                if isinstance(result, asyncio.CancelledError):
+                    raise result
+                self.logger.error(f"Can't get chat from source `{name}` ({result!r})")
+            else:
+                polls.append(self.tag(name, result))
+
+        return self.merge(polls)
+
+    def is_alive(self) -> bool:
+        return any(source.is_alive() for source in self.sources.values())
+
+    def terminate(self):
+        for name, source in self.sources.items():
+            try:
+                source.terminate()
+            except Exception as e:
+                self.logger.error(f"Can't stop chat source `{name}` ({e!r})")
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+def timestamp_of(c) -> int:
+    return c.timestamp or 0
+
+def create_source(video_id: str, config) -> ChatSource:
+    '''
+    Create the chat source selected by `[Backend] chat_source` in the config.
+    If `[Backend.sources]` lists more streams, they're all merged into one source
+    '''
+    extra = dict(config["Backend.sources"]) if config.has_section("Backend.sources") else {}
+    if not extra:
+        return create_single_source(video_id, config)
+
+    # The main stream keeps the usual platform name, the others are tagged with their name in the config
+    sources = {"youtube": create_single_source(video_id, config)}
+    for name, extra_id in extra.items():
+        if name in sources:
+            raise ValueError(f"Chat source name `{name}` in [Backend.sources] is used twice")
+        sources[name] = create_single_source(extra_id, config, replay_path=extra_id)
+
+    logging.getLogger("chatsource").info(f"Merging chat from {len(sources)} sources: {', '.join(sources)}")
+    return MergedSource(sources)
+
+def create_single_source(video_id: str, config, replay_path: str | None = None) -> ChatSource:
+    '''
+    Create one chat source for `video_id`, of the kind in `[Backend] chat_source`.
+    The replay source reads `replay_path`, or `[Backend] replay_path` if it's None
+    '''
+    kind = config["Backend"].get("chat_source", "pytchat")
+
+    if kind == "pytchat":
+        if config["Backend"].get("backend_mode", "thread") == "asyncio":
+            return AsyncPytchatSource(video_id)
+        return PytchatSource(video_id)
+
+    if kind == "replay":
+        return ReplaySource(
+            path=config["Backend"].get("replay_path", video_id) if replay_path is None else replay_path,
+            speed=config["Backend"].getfloat("replay_speed", 1.0),
+            loop=config["Backend"].getboolean("replay_loop", False)
+        )
+
+    raise ValueError(f"Unknown chat source `{kind}`, use `pytchat` or `replay`")
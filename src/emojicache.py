@@ -0,0 +1,52 @@
+'''
+Module for turning :shortcodes: in chat messages into emoji.
+
+Most messages don't have a shortcode in them at all, so those are handed straight back.
+The `emoji` package (and it's data) is only imported the first time a message
+actually has something that looks like a shortcode, and every shortcode is only
+looked up once.
+'''
+
+import re
+import functools
+
+# Change this at build time
+language = "en"
+
+# The most shortcodes to remember, the least recently used ones are forgotten first
+CACHE_SIZE = 4096
+
+# Anything that might be a shortcode, `emoji` decides if it actually is one
+SHORTCODE_CANDIDATE = re.compile(r":[^\s:]+:")
+
+_emoji = None
+
+def _load_emoji():
+    '''
+    Import `emoji` the first time it's needed
+    '''
+    global _emoji
+    if _emoji is None:
+        import emoji
+        _emoji = emoji
+
+    return _emoji
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def lookup_shortcode(shortcode: str) -> str:
+    '''
+    Returns the emoji for a single `:shortcode:`, or the shortcode itself if it isn't one
+    '''
+    return _load_emoji().emojize(shortcode, language=language)
+
+def _replace(match) -> str:
+    return lookup_shortcode(match.group(0))
+
+def emojize(text: str) -> str:
+    '''
+    Replace every :shortcode: in `text` with it's emoji
+    '''
+    if ":" not in text:
+        return text  # Can't have a shortcode without a colon
+
+    return SHORTCODE_CANDIDATE.sub(_replace, text)
@@ -0,0 +1,285 @@
+'''
+Module for autofetch, finding the stream a YouTube channel is live on right now.
+
+https://www.youtube.com/channel/<id>/live points at the channel's stream while it's live.
+It used to be opened in a headless Chrome, now it's fetched over plain HTTP and the video ID
+is read from the redirect or the page's canonical link. Selenium is only used if YouTube
+can't be checked that way and `autofetch_selenium` is on.
+
+Everything is configured in `[Startup]`, `autofetch_base_url` can point at a local server
+for testing.
+'''
+
+import os
+import re
+import time
+import logging
+import http.client
+import urllib.parse
+
+import cachefile
+
+# Bump when the cache file changes shape, old caches are then ignored
+LIVE_CACHE_VERSION = 1
+
+# Redirects followed before giving up, YouTube normally uses at most one
+MAX_REDIRECTS = 5
+
+# Pages bigger than this are cut off, the canonical link is near the top anyway
+MAX_PAGE_BYTES = 4 * 1024 * 1024
+
+WATCH_ID = re.compile(r"[?&]v=([A-Za-z0-9_-]{11})")
+CANONICAL = re.compile(r'<link\s+rel="canonical"\s+href="([^"]+)"')
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+    # Skips the cookie consent page YouTube shows in some countries
+    "Cookie": "CONSENT=YES+; SOCS=CAI",
+}
+
+class ResolveError(Exception):
+    '''
+    Couldn't find out if the channel is live (network errors, pages we don't understand, etc.)
+    '''
+    pass
+
+def video_id_from_url(url: str) -> str | None:
+    '''
+    The video ID in a watch URL, None if it isn't one
+    '''
+    if "/watch" not in url:
+        return None
+
+    match = WATCH_ID.search(url)
+    return match.group(1) if match else None
+
+def video_id_from_page(html: str) -> str | None:
+    '''
+    The live video ID in a /live page, None if the channel isn't live.
+    Raises ResolveError if it doesn't look like a /live page
+    '''
+    match = CANONICAL.search(html)
+    if match is None:
+        raise ResolveError("the page has no canonical link")
+
+    video_id = video_id_from_url(match.group(1))
+    if video_id is None:
+        return None  # Canonical is the channel itself, not live
+
+    # Scheduled streams have a watch page before they start
+    if '"isLiveNow":false' in html:
+        return None
+
+    return video_id
+
+class LiveResolver:
+    '''
+    Finds the video a channel is live on. Keeps it's HTTP connections open between requests,
+    so retries (and checking several channels) don't connect again every time
+    '''
+    def __init__(self, config, logger=None):
+        self.logger = logger or logging.getLogger("livefetch")
+
+        self.base_url = config.get("Startup", "autofetch_base_url", fallback="https://www.youtube.com").rstrip("/")
+        self.retry_count = config.getint("Startup", "autofetch_retry_count", fallback=3)
+        self.retry_delay = config.getfloat("Startup", "autofetch_retry_delay", fallback=0.5)
+        self.timeout = config.getfloat("Startup", "autofetch_timeout", fallback=5)
+        self.use_selenium = config.getboolean("Startup", "autofetch_selenium", fallback=True)
+
+        # Channel ID -> {"video_id", "expires"}, `expires` is wall clock time so it survives restarts
+        cache_path = config.get("Startup", "autofetch_cache", fallback="~/.streamutils_live.json")
+        self.cache_path = os.path.expanduser(cache_path) if cache_path else ""
+        self.cache_ttl = config.getfloat("Startup", "autofetch_cache_ttl", fallback=120)
+        self.cache = self.read_cache()
+
+        # (scheme, host) -> open connection
+        self.connections = {}
+
+    def read_cache(self) -> dict:
+        if not self.cache_path or self.cache_ttl <= 0:
+            return {}
+        return cachefile.read(self.cache_path, LIVE_CACHE_VERSION, "channels", self.logger, "autofetch cache")
+
+    def write_cache(self):
+        if not self.cache_path or self.cache_ttl <= 0:
+            return
+        cachefile.write(self.cache_path, LIVE_CACHE_VERSION, "channels", self.cache, self.logger, "autofetch cache")
+
+    def cached(self, channelid: str) -> str | None:
+        entry = self.cache.get(channelid)
+        if entry is None or entry.get("expires", 0) < time.time():
+            return None
+        return entry.get("video_id")
+
+    def remember(self, channelid: str, video_id: str):
+        now = time.time()
+        self.cache = {k: v for k, v in self.cache.items() if v.get("expires", 0) >= now}  # Drop old channels
+        self.cache[channelid] = {"video_id": video_id, "expires": now + self.cache_ttl}
+        self.write_cache()
+
+    def connection(self, scheme: str, host: str) -> http.client.HTTPConnection:
+        '''
+        An open connection to `host`, the same one every time unless it broke
+        '''
+        key = (scheme, host)
+        conn = self.connections.get(key)
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+            elif scheme == "http":
+                conn = http.client.HTTPConnection(host, timeout=self.timeout)
+            else:
+                raise ResolveError(f"can't fetch {scheme}:// URLs")
+            self.connections[key] = conn
+        return conn
+
+    def drop_connection(self, scheme: str, host: str):
+        conn = self.connections.pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+
+    def fetch(self, url: str) -> tuple[int, http.client.HTTPMessage, bytes]:
+        '''
+        GET `url` without following redirects. Returns (status, headers, body)
+        '''
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+
+        # A kept-alive connection may have been closed by the server since, then it's tried once more on a new one
+        for fresh in ((parts.scheme, parts.netloc) not in self.connections, True):
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=HEADERS)
+                response = conn.getresponse()
+                body = response.read(MAX_PAGE_BYTES)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.drop_connection(parts.scheme, parts.netloc)
+                if fresh:
+                    raise
+                continue
+            except (OSError, http.client.HTTPException):
+                self.drop_connection(parts.scheme, parts.netloc)
+                raise
+
+            # Unread data (or the server asking) means the connection can't be used again
+            if response.will_close or not response.isclosed():
+                self.drop_connection(parts.scheme, parts.netloc)
+
+            return response.status, response.headers, body
+
+    def resolve_once(self, channelid: str) -> str | None:
+        '''
+        Check once, returns the video ID or None if the channel isn't live.
+        Raises ResolveError (or OSError, HTTPException) if it couldn't find out
+        '''
+        url = f"{self.base_url}/channel/{channelid}/live"
+        for _ in range(MAX_REDIRECTS + 1):
+            status, headers, body = self.fetch(url)
+
+            if status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, headers.get("Location", ""))
+                video_id = video_id_from_url(url)
+                if video_id is not None:
+                    return video_id
+                if "consent." in urllib.parse.urlsplit(url).netloc:
+                    raise ResolveError("redirected to the cookie consent page")
+                continue
+
+            if status == 404:
+                self.logger.error(f"Channel {channelid} doesn't exist")
+                return None
+
+            if status != 200:
+                raise ResolveError(f"HTTP {status} from {url}")
+
+            return video_id_from_page(body.decode("utf-8", "replace"))
+
+        raise ResolveError(f"more than {MAX_REDIRECTS} redirects")
+
+    def resolve(self, channelid: str) -> str | None:
+        '''
+        Returns the video ID the channel is live on, or None if it isn't live (or we can't tell).
+        Tries `autofetch_retry_count` more times if YouTube can't be reached
+        '''
+        video_id = self.cached(channelid)
+        if video_id is not None:
+            self.logger.info(f"{channelid} was live on {video_id} a moment ago, using that")
+            return video_id
+
+        attempts = self.retry_count + 1
+        delay = self.retry_delay
+        for attempt in range(1, attempts + 1):
+            try:
+                video_id = self.resolve_once(channelid)
+                break
+            except (ResolveError, OSError, http.client.HTTPException) as e:
+                self.logger.warning(f"Attempt {attempt}/{attempts} to check if {channelid} is live failed ({e!r})")
+                if attempt < attempts:
+                    time.sleep(delay)
+                    delay *= 2
+        else:
+            if not self.use_selenium:
+                self.logger.error(f"Can't check if {channelid} is live")
+                return None
+
+            self.logger.warning("Falling back to Selenium")
+            video_id = resolve_with_selenium(f"{self.base_url}/channel/{channelid}/live", self.timeout, self.logger)
+
+        if video_id is not None:
+            self.remember(channelid, video_id)
+        return video_id
+
+    def close(self):
+        for scheme, host in list(self.connections):
+            self.drop_connection(scheme, host)
+
+def resolve_with_selenium(url: str, timeout: float, logger=None) -> str | None:
+    '''
+    The old way, open the /live page in a headless Chrome. Needs Selenium and Chrome installed
+    '''
+    logger = logger or logging.getLogger("livefetch")
+    try:
+        from selenium import webdriver
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+    except ImportError:
+        logger.error("Selenium isn't installed, can't fall back to it")
+        return None
+
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")  # Headless mode
+    options.add_argument("--disable-gpu")
+
+    logger.info("Creating selenium instance...")
+    try:
+        driver = webdriver.Chrome(options=options)
+    except WebDriverException as e:
+        logger.error(f"Can't start Chrome ({e.msg})")
+        return None
+
+    try:
+        driver.get(url)
+
+        # Wait for a redirect to the stream, instead of always sleeping
+        try:
+            WebDriverWait(driver, timeout).until(lambda d: "/live" not in d.current_url)
+        except TimeoutException:
+            pass
+
+        finalurl = driver.current_url
+        logger.info(f"Final URL is `{finalurl}`")
+        if "/live" not in finalurl:
+            return video_id_from_url(finalurl)
+
+        # Newer pages stay on /live and only link to the stream
+        links = driver.find_elements(By.CSS_SELECTOR, 'link[rel="canonical"]')
+        return video_id_from_url(links[0].get_attribute("href")) if links else None
+    except WebDriverException as e:
+        logger.error(f"Selenium failed ({e.msg})")
+        return None
+    finally:
+        driver.quit()
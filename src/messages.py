@@ -0,0 +1,127 @@
+'''
+Module containing the message model shared by the GUI and plugins.
+
+Every chat message is turned into one `XMessageContainer` as soon as it's fetched,
+that same object is formatted for the GUI and handed to every plugin. They're
+frozen (and use __slots__), so they're small and nobody can change a message that
+another thread is still reading.
+'''
+
+from dataclasses import dataclass
+from itertools import product
+from types import MappingProxyType
+
+ROLE_NAMES = ("owner", "moderator", "sponsor", "verified")
+
+# Every combination of roles, shared between messages instead of making a new set every time
+# Key is (owner, moderator, sponsor, verified)
+ROLE_SETS = {
+    flags: frozenset(role for role, flag in zip(ROLE_NAMES, flags) if flag)
+    for flags in product((False, True), repeat=4)
+}
+
+@dataclass(frozen=True, slots=True)
+class XAuthorContainer:
+    platform:            str
+    name:                str
+    id:                  str
+    url:                 str | None
+    image_url:           str | None
+
+    # Any of "owner", "moderator", "sponsor" and "verified"
+    roles:               frozenset[str]
+
+    def has_role(self, role: str) -> bool:
+        return role in self.roles
+
+    def to_tuple(self) -> tuple:
+        '''
+        Compact form for sending to another process, see `from_tuple`
+        '''
+        roles = self.roles
+        return (self.platform, self.name, self.id, self.url, self.image_url, tuple(role in roles for role in ROLE_NAMES))
+
+    @classmethod
+    def from_tuple(cls, t: tuple):
+        platform, name, id, url, image_url, flags = t
+        return cls(platform, name, id, url, image_url, ROLE_SETS[flags])
+
+@dataclass(frozen=True, slots=True)
+class XMessageContainer:
+    '''
+    One chat message. The same object is read by the GUI and every plugin, from different
+    threads, so it can't be changed. `platform_specific` is a read-only mapping for the same
+    reason, but what's in it (like `messageEx`, a list) isn't copied, plugins must not change it
+    '''
+    platform:               str
+
+    # Cross platform stuff
+    type:                   str
+    id:                     str
+    message:                str
+    timestamp:              int  # Milliseconds since the UNIX epoch
+    datetime:               str | None
+    dono_amount:            float | None
+    dono_amount_string:     str
+    dono_currency:          str
+    dono_colour:            int
+    author:                 XAuthorContainer
+
+    # Platform specifics, read-only
+    platform_specific:      MappingProxyType
+
+    def to_tuple(self) -> tuple:
+        '''
+        Compact form for sending to another process, just the values in field order
+        '''
+        return (
+            self.platform, self.type, self.id, self.message, self.timestamp, self.datetime,
+            self.dono_amount, self.dono_amount_string, self.dono_currency, self.dono_colour,
+            self.author.to_tuple(), dict(self.platform_specific),  # Mapping proxies can't be pickled
+        )
+
+    @classmethod
+    def from_tuple(cls, t: tuple):
+        '''
+        The opposite of `to_tuple`
+        '''
+        *fields, author, platform_specific = t
+        return cls(*fields, XAuthorContainer.from_tuple(author), MappingProxyType(platform_specific))
+
+    @classmethod
+    def from_pytchat(cls, c, message: str | None = None, platform: str = "youtube"):
+        '''
+        Build a message from a pytchat message (or anything that looks like one)
+        `message` replaces the message text, for example after emoji are converted.
+        `platform` is where it came from, see `chatsources.MergedSource`
+        '''
+        a = c.author
+        roles = ROLE_SETS[(bool(a.isChatOwner), bool(a.isChatModerator), bool(a.isChatSponsor), bool(a.isVerified))]
+
+        author = XAuthorContainer(
+            platform=platform,
+            name=a.name,
+            id=a.channelId,
+            url=a.channelUrl,
+            image_url=a.imageUrl,
+            roles=roles,
+        )
+
+        return cls(
+            platform=platform,
+            type=c.type,
+            id=c.id,
+            message=c.message if message is None else message,
+            timestamp=c.timestamp,
+            datetime=c.datetime,
+            dono_amount=c.amountValue,
+            dono_amount_string=c.amountString,
+            dono_currency=c.currency,
+            dono_colour=c.bgColor,
+            author=author,
+            platform_specific=MappingProxyType({
+                "messageEx": c.messageEx,
+                "elapsedTime": c.elapsedTime,
+                "badgeUrl": a.badgeUrl,
+            }),
+        )
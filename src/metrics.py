@@ -0,0 +1,285 @@
+'''
+Module for runtime metrics, like how long each plugin takes and how big each chat poll is.
+
+Metrics are always collected, they're just a few counters and histograms so it's cheap.
+They can be read in two ways, both off by default (see `[Metrics]` in the config):
+- A local HTTP endpoint in Prometheus text format, at http://127.0.0.1:<http_port>/metrics
+- A summary written to the log every `dump_interval` seconds
+'''
+
+import bisect
+import logging
+import threading
+
+# Histogram buckets for times, in seconds
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histogram buckets for counts, like messages per poll
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Counter:
+    '''
+    A number that only goes up
+    '''
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name:str, labels:str):
+        yield name, labels, self.value
+
+class Histogram:
+    '''
+    Counts values into buckets, like Prometheus histograms
+    '''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q:float) -> float:
+        '''
+        Rough quantile, the upper bound of the bucket it falls in
+        '''
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+
+        if count == 0:
+            return float("nan")
+
+        target = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def samples(self, name:str, labels:str):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            yield f"{name}_bucket", join_labels(labels, f'le="{bound}"'), cumulative
+        yield f"{name}_bucket", join_labels(labels, 'le="+Inf"'), count
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, count
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def join_labels(*labels) -> str:
+    return ",".join(label for label in labels if label)
+
+class MetricFamily:
+    '''
+    Every metric with one name, one child metric for each set of label values
+    '''
+    def __init__(self, name:str, help:str, kind:str, labelnames:tuple, create):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = labelnames
+        self.create = create
+
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        '''
+        Returns the metric for these label values, creating it the first time
+        '''
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.create())
+        return child
+
+    # For metrics without labels
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def collect(self):
+        for values, child in list(self.children.items()):
+            labels = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, values))
+            yield from child.samples(self.name, labels)
+
+class CallbackFamily:
+    '''
+    Metric whose values are read from a function when they're collected, nothing to update.
+    `function` returns (label values, value) pairs
+    '''
+    def __init__(self, name:str, help:str, kind:str, labelnames:tuple, function):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = labelnames
+        self.function = function
+
+    def collect(self):
+        for values, value in self.function():
+            labels = ",".join(f'{name}="{escape_label(v)}"' for name, v in zip(self.labelnames, values))
+            yield self.name, labels, value
+
+class Registry:
+    '''
+    Holds every metric
+    '''
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def add(self, family):
+        with self.lock:
+            # Modules can be imported more than once (plugins, benchmarks), keep the first
+            return self.families.setdefault(family.name, family)
+
+    def counter(self, name:str, help:str, labelnames:tuple=()) -> MetricFamily:
+        return self.add(MetricFamily(name, help, "counter", labelnames, Counter))
+
+    def histogram(self, name:str, help:str, labelnames:tuple=(), buckets=TIME_BUCKETS) -> MetricFamily:
+        return self.add(MetricFamily(name, help, "histogram", labelnames, lambda: Histogram(buckets)))
+
+    def callback(self, name:str, help:str, kind:str, labelnames:tuple, function) -> CallbackFamily:
+        '''
+        Replaces any callback with the same name, the function usually belongs to an object
+        that can be created again (like PluginManager)
+        '''
+        family = CallbackFamily(name, help, kind, labelnames, function)
+        with self.lock:
+            self.families[name] = family
+        return family
+
+    def render(self) -> str:
+        '''
+        Every metric in Prometheus text format
+        '''
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            try:
+                for name, labels, value in family.collect():
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+            except Exception as e:
+                # A callback failed, the rest are still worth having
+                lines.append(f"# Can't collect {family.name} ({e!r})")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list[str]:
+        '''
+        Short, human readable lines for the log
+        '''
+        lines = []
+        for family in list(self.families.values()):
+            if isinstance(family, CallbackFamily):
+                for values, value in family.function():
+                    lines.append(f"{family.name}{list(values) if values else ''} = {value}")
+                continue
+
+            for values, child in list(family.children.items()):
+                label = list(values) if values else ""
+                if isinstance(child, Histogram):
+                    if child.count:
+                        lines.append(f"{family.name}{label} count={child.count} mean={child.sum / child.count:.6g} p50<={child.quantile(0.5)} p99<={child.quantile(0.99)}")
+                else:
+                    lines.append(f"{family.name}{label} = {child.value}")
+
+        return lines
+
+# Every metric in the program goes here
+REGISTRY = Registry()
+
+def make_handler(registry):
+    '''
+    Returns an HTTP request handler that serves `registry`.
+    `http.server` is only imported here, most people never turn the endpoint on
+    '''
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.getLogger("metrics").debug(format % args)
+
+    return MetricsHandler
+
+class MetricsExporter:
+    '''
+    Starts the HTTP endpoint and the periodic dump, as configured in `[Metrics]`
+    '''
+    def __init__(self, config, registry=REGISTRY):
+        self.registry = registry
+        self.logger = logging.getLogger("metrics")
+
+        section = config["Metrics"] if config.has_section("Metrics") else {}
+        self.host = section.get("http_host", "127.0.0.1")
+        self.port = int(section.get("http_port", 0))
+        self.dump_interval = float(section.get("dump_interval", 0))
+
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        if self.port:
+            from http.server import ThreadingHTTPServer
+
+            self.server = ThreadingHTTPServer((self.host, self.port), make_handler(self.registry))
+            self.server.daemon_threads = True
+            self.threads.append(threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True))
+            self.logger.info(f"Serving metrics at http://{self.host}:{self.server.server_address[1]}/metrics")
+
+        if self.dump_interval > 0:
+            self.threads.append(threading.Thread(target=self.dump_loop, name="metrics-dump", daemon=True))
+            self.logger.info(f"Logging metrics every {self.dump_interval} seconds")
+
+        for thread in self.threads:
+            thread.start()
+
+    def dump_loop(self):
+        while not self.stopped.wait(self.dump_interval):
+            self.dump()
+
+    def dump(self):
+        for line in self.registry.summary():
+            self.logger.info(line)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,173 @@
+'''
+Module for the notification bus, how plugins send things to each other.
+
+Plugins `subscribe` to topics and `publish` payloads to them (see `pluginsdk.PluginInterface`).
+Publishing never waits for the subscribers: each subscriber has it's own bounded queue
+of notifications, which are handed to it in batches through it's normal plugin event queue,
+so they're in order with everything else it gets.
+'''
+
+from dataclasses import dataclass
+from typing import Any
+import collections
+import inspect
+import threading
+import logging
+
+import metrics
+
+NOTIFICATIONS_PUBLISHED = metrics.REGISTRY.counter("streamutils_notifications_published_total", "Notifications published by each plugin", ("plugin",))
+NOTIFICATIONS_DELIVERED = metrics.REGISTRY.counter("streamutils_notifications_delivered_total", "Notifications delivered to each plugin", ("plugin",))
+NOTIFICATIONS_DROPPED = metrics.REGISTRY.counter("streamutils_notifications_dropped_total", "Notifications thrown away because a plugin's queue was full", ("plugin",))
+
+@dataclass(frozen=True, slots=True)
+class Notification:
+    topic:      str
+    source:     str | None  # Name of the plugin that sent it, None if it wasn't a plugin
+    payload:    Any
+
+class NotificationBus:
+    '''
+    Keeps track of who's subscribed to what, and the notifications waiting for each plugin
+    '''
+    def __init__(self, manager, queue_size:int=100, batch_size:int=32, logger=None):
+        # The PluginManager, notifications are delivered through it's plugin queues
+        self.manager = manager
+
+        # The most notifications that can wait for one plugin, the oldest are dropped first
+        self.queue_size = queue_size
+
+        # The most notifications handed to a plugin at once
+        self.batch_size = batch_size
+
+        self.logger = logger or logging.getLogger("notifybus")
+
+        # Topic -> frozenset of plugin names. Replaced (never changed) so `publish` doesn't need the lock
+        self.subscriptions = {}
+
+        # Plugin name -> notifications waiting for it
+        self.pending = {}
+
+        self.lock = threading.Lock()
+
+    def subscribe(self, plugin_name:str, topic:str):
+        with self.lock:
+            subscriptions = dict(self.subscriptions)
+            subscriptions[topic] = subscriptions.get(topic, frozenset()) | {plugin_name}
+            self.subscriptions = subscriptions
+            self.pending.setdefault(plugin_name, collections.deque())
+
+        self.logger.info(f"{plugin_name} subscribed to `{topic}`")
+
+    def unsubscribe(self, plugin_name:str, topic:str):
+        with self.lock:
+            subscriptions = dict(self.subscriptions)
+            subscribers = subscriptions.get(topic, frozenset()) - {plugin_name}
+            if subscribers:
+                subscriptions[topic] = subscribers
+            else:
+                subscriptions.pop(topic, None)
+            self.subscriptions = subscriptions
+
+    def publish(self, source:str | None, topic:str, payload):
+        '''
+        Send `payload` to every plugin subscribed to `topic`, returns how many there are
+        '''
+        subscribers = self.subscriptions.get(topic, ())
+        if source is not None:
+            NOTIFICATIONS_PUBLISHED.labels(source).inc()
+
+        notification = Notification(topic, source, payload)
+        for plugin_name in subscribers:
+            self.send(plugin_name, notification)
+
+        return len(subscribers)
+
+    def send(self, plugin_name:str, notification:Notification):
+        '''
+        Add a notification to one plugin's queue, and make sure a delivery is on it's way
+        '''
+        with self.lock:
+            pending = self.pending.setdefault(plugin_name, collections.deque())
+            if len(pending) >= self.queue_size:
+                pending.popleft()
+                dropped = True
+            else:
+                dropped = False
+            pending.append(notification)
+
+        if dropped:
+            NOTIFICATIONS_DROPPED.labels(self.manager.metric_names.get(plugin_name, plugin_name)).inc()
+
+        self.schedule(plugin_name)
+
+    def schedule(self, plugin_name:str):
+        '''
+        Queue a delivery for a plugin in it's plugin queue, unless one is already waiting there.
+        It's coalesced so it never waits for room, even with `overflow_policy = block`
+        '''
+        deliver = self.deliver_async if plugin_name in self.manager.async_plugins else self.deliver
+        self.manager.queue_event(plugin_name, "event_notifications", deliver, (plugin_name,), coalesce=True)
+
+    def take(self, plugin_name:str) -> tuple:
+        '''
+        Remove up to `batch_size` notifications waiting for a plugin.
+        If there's more left another delivery is queued, so other events get a turn in between
+        '''
+        with self.lock:
+            pending = self.pending[plugin_name]
+            batch = tuple(pending.popleft() for _ in range(min(len(pending), self.batch_size)))
+            more = bool(pending)
+
+        if more:
+            self.schedule(plugin_name)
+
+        if batch:
+            NOTIFICATIONS_DELIVERED.labels(self.manager.metric_names.get(plugin_name, plugin_name)).inc(len(batch))
+        return batch
+
+    def deliver(self, plugin_name:str):
+        '''
+        Runs from the plugin's queue, hands it the notifications waiting for it
+        '''
+        batch = self.take(plugin_name)
+        if batch:
+            self.manager.plugins[plugin_name].event_notifications(batch)
+
+    async def deliver_async(self, plugin_name:str):
+        '''
+        The same as `deliver`, for async plugins
+        '''
+        batch = self.take(plugin_name)
+        if not batch:
+            return
+
+        plugin = self.manager.plugins[plugin_name]
+        if self.manager.is_plugin_notify_batched(plugin):
+            result = plugin.event_notifications(batch)
+            if inspect.isawaitable(result):
+                await result
+            return
+
+        for notification in batch:
+            result = plugin.event_notify(notification.source, notification)
+            if inspect.isawaitable(result):
+                await result
+
+class PluginBus:
+    '''
+    What a plugin gets as `__bus__`, it knows which plugin is using it
+    '''
+    def __init__(self, bus:NotificationBus, plugin_name:str, source:str):
+        self.bus = bus
+        self.plugin_name = plugin_name
+        self.source = source
+
+    def publish(self, topic:str, payload) -> int:
+        return self.bus.publish(self.source, topic, payload)
+
+    def subscribe(self, topic:str):
+        self.bus.subscribe(self.plugin_name, topic)
+
+    def unsubscribe(self, topic:str):
+        self.bus.unsubscribe(self.plugin_name, topic)
@@ -0,0 +1,286 @@
+'''
+Module for running plugins in their own process.
+
+Plugins that do a lot of CPU work (scoring, regex over every message, etc.) fight with
+the chat thread and the GUI for the GIL. Plugins listed in `[Plugins] process_plugins`
+are loaded in a separate process instead, and PluginManager talks to them through a
+`ProcessPluginProxy`, which looks just like any other plugin.
+
+Messages are sent across as plain tuples (see `XMessageContainer.to_tuple`), anything
+the plugin sends to `__signal__` or logs is sent back to this process.
+
+A plugin's `match_message` can't be called from here without a round trip for every
+message, so plugins that have one get every message sent across and are filtered over
+there instead, by their prefixes and `match_message`.
+'''
+
+import inspect
+import logging
+import logging.handlers
+import threading
+import queue
+import importlib.util
+import multiprocessing
+
+import pluginsdk
+from messages import XMessageContainer
+
+# How long to wait for a plugin process to exit before killing it, in seconds
+EXIT_TIMEOUT = 5
+
+class _ConnectionSender:
+    '''
+    Sends to a multiprocessing connection from any thread
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, item):
+        with self.lock:
+            self.conn.send(item)
+
+class _SignalProxy:
+    '''
+    Stands in for the GUI signal inside the plugin process
+    '''
+    def __init__(self, sender):
+        self.sender = sender
+
+    def emit(self, text):
+        self.sender.send(("signal", text))
+
+class _BusProxy:
+    '''
+    Stands in for the notification bus inside the plugin process
+    '''
+    def __init__(self, sender):
+        self.sender = sender
+
+    def publish(self, topic, payload):
+        self.sender.send(("publish", (topic, payload)))
+        return None  # Not known over here
+
+    def subscribe(self, topic):
+        self.sender.send(("subscribe", topic))
+
+    def unsubscribe(self, topic):
+        self.sender.send(("unsubscribe", topic))
+
+class _LogForwarder(logging.handlers.QueueHandler):
+    '''
+    Sends log records back to the main process, where they're logged normally
+    '''
+    def __init__(self, sender):
+        super().__init__(None)
+        self.sender = sender
+
+    def enqueue(self, record):
+        self.sender.send(("log", record))
+
+def _load_plugin(plugin_name, plugin_path):
+    '''
+    Load a plugin's module and create the plugin, the same way PluginManager does
+    '''
+    spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    for name, obj in inspect.getmembers(module):
+        if inspect.isclass(obj) and issubclass(obj, pluginsdk.PluginInterface) and obj != pluginsdk.PluginInterface:
+            return obj()
+
+    raise ImportError(f"{plugin_path} doesn't contain a plugin")
+
+class _MessageFilter:
+    '''
+    Does the router's job inside the plugin process, for plugins with a `match_message`
+    '''
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.prefixes = None
+
+    def set_prefixes(self, prefixes):
+        # None means the plugin wants every message anyway
+        self.prefixes = None if prefixes is None else tuple(prefixes)
+
+    def wanted(self, messages):
+        if self.prefixes is None:
+            return messages
+        return tuple(m for m in messages if m.message.startswith(self.prefixes) or self.plugin.match_message(m))
+
+def plugin_host(conn, plugin_name, plugin_path, json_path):
+    '''
+    Runs in the plugin process. Loads the plugin, then runs every call sent to it in order
+    '''
+    sender = _ConnectionSender(conn)
+
+    try:
+        plugin = _load_plugin(plugin_name, plugin_path)
+        plugin.__name__ = plugin_name
+        plugin.__file__ = plugin_path
+        plugin.__json__ = json_path
+        plugin.__signal__ = _SignalProxy(sender)
+        plugin.__bus__ = _BusProxy(sender)
+
+        has_match = type(plugin).match_message is not pluginsdk.PluginInterface.match_message
+        message_filter = _MessageFilter(plugin) if has_match else None
+    except Exception as e:
+        plugin = None
+        load_error = f"Can't load plugin in it's process ({e!r})"
+
+    while True:
+        try:
+            function_name, args = conn.recv()
+        except (EOFError, OSError):
+            break  # The main process is gone
+
+        if function_name == "exit":
+            break
+
+        if plugin is None:
+            sender.send(("error", load_error))
+            continue
+
+        try:
+            if function_name == "event_load":
+                # Loggers can't be sent between processes, make one that sends records back
+                logger = logging.getLogger(f"plugins.{plugin_name}")
+                logger.setLevel(args[0])
+                logger.propagate = False
+                logger.addHandler(_LogForwarder(sender))
+                args = (logger,)
+
+            elif function_name == "event_messages":
+                messages = tuple(XMessageContainer.from_tuple(t) for t in args[0])
+                if message_filter is not None:
+                    messages = message_filter.wanted(messages)
+                    if not messages:
+                        sender.send(("return", None))
+                        continue
+                args = (messages,)
+
+            if function_name == "getattr":
+                result = getattr(plugin, args[0])  # For class attributes like tick_interval_ns
+            elif function_name == "message_prefixes" and message_filter is not None:
+                # Ask for everything, it's filtered here
+                message_filter.set_prefixes(plugin.message_prefixes())
+                result = None
+            else:
+                result = getattr(plugin, function_name)(*args)
+            sender.send(("return", result))
+        except Exception as e:
+            sender.send(("error", f"{function_name} caused an exception ({e!r})"))
+
+    conn.close()
+
+class ProcessPluginProxy(pluginsdk.PluginInterface):
+    '''
+    Stands in for a plugin that runs in it's own process.
+    Every call blocks until the plugin process has run it, PluginManager already only
+    runs one call per plugin at a time so calls stay in order.
+    '''
+    def __init__(self, plugin_name, plugin_path, json_path):
+        self.plugin_name = plugin_name
+        self.logger = logging.getLogger("pluginproc")
+
+        # Spawn works the same everywhere and doesn't copy our threads (or Qt) into the child
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=plugin_host,
+            args=(child_conn, plugin_name, plugin_path, json_path),
+            name=f"plugin-{plugin_name}",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.sender = _ConnectionSender(self.conn)
+        self.results = queue.Queue()
+
+        # Reads everything the plugin process sends back
+        self.reader = threading.Thread(target=self.read_loop, name=f"pluginproc-{plugin_name}", daemon=True)
+        self.reader.start()
+
+        self.logger.info(f"Started process {self.process.pid} for plugin {plugin_name}")
+
+        # The settings the plugin manager reads from the plugin itself
+        self.tick_interval_ns = self.call("getattr", "tick_interval_ns")
+
+    def read_loop(self):
+        while True:
+            try:
+                kind, value = self.conn.recv()
+            except (EOFError, OSError):
+                self.results.put(("error", "the plugin process exited"))
+                return
+
+            if kind == "signal":
+                signal = getattr(self, "__signal__", None)
+                if signal is not None:
+                    signal.emit(value)
+            elif kind == "log":
+                logging.getLogger(value.name).handle(value)
+            elif kind in ("publish", "subscribe", "unsubscribe"):
+                bus = getattr(self, "__bus__", None)
+                if bus is None:
+                    self.logger.warning(f"Plugin {self.plugin_name} used the notification bus before it was loaded")
+                elif kind == "publish":
+                    bus.publish(*value)
+                else:
+                    getattr(bus, kind)(value)
+            else:
+                self.results.put((kind, value))
+
+    def call(self, function_name, *args):
+        '''
+        Run a function in the plugin process and return what it returns
+        '''
+        if not self.process.is_alive():
+            raise RuntimeError(f"Plugin process for {self.plugin_name} isn't running")
+
+        self.sender.send((function_name, args))
+        kind, value = self.results.get()
+        if kind == "error":
+            raise RuntimeError(value)
+
+        return value
+
+    def event_load(self, logger):
+        self.call("event_load", logger.getEffectiveLevel())
+
+    def configure(self, config):
+        self.call("configure", config)
+
+    def message_prefixes(self):
+        return self.call("message_prefixes")
+
+    def event_message(self, message):
+        self.call("event_messages", [message.to_tuple()])
+
+    def event_messages(self, messages):
+        self.call("event_messages", [m.to_tuple() for m in messages])
+
+    def event_main(self, t, loop_wait):
+        self.call("event_main", t, loop_wait)
+
+    def event_notify(self, source, data):
+        self.call("event_notify", source, data)
+
+    def event_notifications(self, notifications):
+        self.call("event_notifications", notifications)
+
+    def event_kill(self):
+        try:
+            self.call("event_kill")
+        finally:
+            try:
+                self.sender.send(("exit", ()))
+            except (OSError, ValueError):
+                pass  # Already gone
+
+            self.process.join(EXIT_TIMEOUT)
+            if self.process.is_alive():
+                self.logger.warning(f"Plugin process for {self.plugin_name} didn't exit, killing it")
+                self.process.kill()
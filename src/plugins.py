@@ -3,9 +3,256 @@ import concurrent.futures as cf
 import importlib.util
 import inspect
 import pluginsdk
+import metrics
+import tracing
+import notifybus
+import cachefile
 import json
 import logging
 import types
+import threading
+import collections
+import asyncio
+import heapq
+import time
+
+# What a full plugin event queue can do with a new event
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+# Every event method a plugin can make `async def`
+ASYNC_EVENTS = ("event_load", "event_kill", "event_message", "event_messages", "event_notify", "event_main", "configure")
+
+# How long to wait for an async `event_kill` to finish, in seconds
+KILL_TIMEOUT = 5
+
+# Changed whenever the discovery cache's layout changes, old caches are ignored
+DISCOVERY_CACHE_VERSION = 1
+
+PLUGIN_EVENTS = metrics.REGISTRY.counter("streamutils_plugin_events_total", "Plugin events run", ("plugin", "event"))
+PLUGIN_ERRORS = metrics.REGISTRY.counter("streamutils_plugin_errors_total", "Plugin events that raised an exception", ("plugin", "event"))
+PLUGIN_EVENT_SECONDS = metrics.REGISTRY.histogram("streamutils_plugin_event_seconds", "How long plugin events take to run", ("plugin", "event"))
+
+def mtime_ns(path:str) -> int | None:
+    '''
+    Returns when a file was last changed, or None if it doesn't exist
+    '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class PluginEventQueue:
+    '''
+    Ordered queue of events waiting for one plugin.
+    Only one worker runs a plugin's events at a time, so a plugin always gets it's events
+    in the order they were sent.
+    '''
+    def __init__(self, maxlen=None, policy="drop-oldest"):
+        # Each event is (function_name, function, args)
+        self.events = collections.deque()
+
+        # The most events that can wait, None means there's no limit
+        self.maxlen = maxlen
+
+        # What to do when the queue is full, one of OVERFLOW_POLICIES
+        self.policy = policy
+
+        # True while a worker is (or is about to start) running events from this queue
+        self.scheduled = False
+
+        # Number of events thrown away because the queue was full
+        self.dropped = 0
+
+        # Set when the plugins are unloaded, nothing can be queued after that
+        self.closed = False
+
+        # Function name -> the coalesced event with that name waiting in the queue, see `put`
+        self.coalesced = {}
+
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, event, coalesce=False) -> bool:
+        '''
+        Add an event to the queue.
+        With `coalesce`, nothing is added while an event with the same function name (also
+        queued with `coalesce`) is still waiting, that one will do. A coalesced event never
+        waits for room with the block policy, there's only ever one of it so it's let in.
+        Returns True if a worker needs to be started to run it, False otherwise
+        '''
+        with self.condition:
+            if coalesce and event[0] in self.coalesced:
+                return False
+
+            if self.maxlen is not None and len(self.events) >= self.maxlen:
+                if self.policy == "block" and coalesce:
+                    pass  # Let it in, blocking here could deadlock plugins publishing to each other
+
+                elif self.policy == "block":
+                    # Wait for the plugin to catch up
+                    while len(self.events) >= self.maxlen and not self.closed:
+                        self.condition.wait()
+
+                elif self.policy == "drop-oldest":
+                    self.forget(self.events.popleft())
+                    self.dropped += 1
+
+                else:  # drop-newest
+                    self.dropped += 1
+                    return False
+
+            if self.closed:
+                return False
+
+            self.events.append(event)
+            if coalesce:
+                self.coalesced[event[0]] = event
+            if self.scheduled:
+                return False  # The worker that's already running will get to it
+
+            self.scheduled = True
+            return True
+
+    def take(self):
+        '''
+        Remove and return the next event, or None when the queue is empty.
+        Returning None also means the worker running this queue has stopped
+        '''
+        with self.condition:
+            if not self.events:
+                self.scheduled = False
+                return None
+
+            event = self.events.popleft()
+            self.forget(event)
+            self.condition.notify()  # Wake up anyone blocked in `put`
+            return event
+
+    def close(self):
+        '''
+        Throw away every waiting event and refuse new ones
+        '''
+        with self.condition:
+            self.closed = True
+            self.dropped += len(self.events)
+            self.events.clear()
+            self.coalesced.clear()
+            self.condition.notify_all()
+
+    def forget(self, event):
+        '''
+        Called with the lock held when an event leaves the queue, so another one like it can be coalesced again
+        '''
+        if self.coalesced.get(event[0]) is event:
+            del self.coalesced[event[0]]
+
+class PrefixRouter:
+    '''
+    Decides which plugins get which messages.
+    Prefixes that plugins ask for are kept in a trie, so finding every plugin that wants a
+    message only looks at the start of the message once, no matter how many plugins there are.
+    Plugins that aren't in the router get every message
+    '''
+    def __init__(self):
+        # Each node is a dict of character -> node, the "" key holds the names of plugins
+        # whose prefix ends at that node
+        self.root = {}
+
+        # Plugins with a `match_message` function, (name, function)
+        self.predicates = []
+
+        # Every plugin that only gets some messages
+        self.routed_plugins = set()
+
+    def add_prefix(self, plugin_name:str, prefix:str):
+        node = self.root
+        for character in prefix:
+            node = node.setdefault(character, {})
+        node.setdefault("", set()).add(plugin_name)
+        self.routed_plugins.add(plugin_name)
+
+    def add_predicate(self, plugin_name:str, function):
+        self.predicates.append((plugin_name, function))
+        self.routed_plugins.add(plugin_name)
+
+    def match(self, text:str) -> set:
+        '''
+        Returns the names of the routed plugins that have a prefix of `text`
+        '''
+        matched = set()
+        node = self.root
+        if "" in node:
+            matched |= node[""]
+
+        for character in text:
+            node = node.get(character)
+            if node is None:
+                break
+            if "" in node:
+                matched |= node[""]
+
+        return matched
+
+    def route(self, messages) -> dict:
+        '''
+        Returns a dictionary of plugin name -> the messages it wants, for routed plugins only
+        '''
+        routed = {}
+        for message in messages:
+            matched = self.match(message.message)
+            for name, function in self.predicates:
+                if name not in matched and function(message):
+                    matched.add(name)
+
+            for name in matched:
+                routed.setdefault(name, []).append(message)
+
+        return routed
+
+class TickScheduler:
+    '''
+    Decides when each plugin's `event_main` is due.
+    Plugins with a tick interval are kept in a heap ordered by when they're due next, so
+    each poll only looks at the plugins that are actually due. Ticks missed because the polls
+    were further apart than a plugin's interval are merged into one
+    '''
+    def __init__(self):
+        # Plugins that tick on every poll
+        self.every_poll = []
+
+        # (when it's due in `time.monotonic_ns()`, plugin name)
+        self.heap = []
+
+        # Plugin name -> interval in nanoseconds
+        self.intervals = {}
+
+    def add(self, plugin_name:str, interval_ns:int, now:int):
+        self.intervals[plugin_name] = interval_ns
+        if interval_ns == 0:
+            self.every_poll.append(plugin_name)
+        else:
+            heapq.heappush(self.heap, (now, plugin_name))  # First tick on the next poll
+
+    def due(self, now:int) -> list:
+        '''
+        Returns the names of the plugins that should tick now, and schedules their next tick
+        '''
+        names = list(self.every_poll)
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            due, name = heap[0]
+            interval = self.intervals[name]
+
+            next_due = due + interval
+            if next_due <= now:
+                next_due = now + interval  # Missed at least one, don't try to catch up
+
+            heapq.heapreplace(heap, (next_due, name))
+            names.append(name)
+
+        return names
 
 class PluginManager:
     '''
@@ -21,6 +268,15 @@ class PluginManager:
         # To hold plugins, key is the name of the plugin, value is the object
         self.plugins = {}
 
+        # Names of plugins that take a whole poll of messages at once with `event_messages`
+        self.batched_plugins = set()
+
+        # Which messages each plugin wants, name -> list of prefixes (None for everything)
+        # A plugin is only added once it's configured, until then it gets every message
+        self.plugin_prefixes = {}
+        self.router = PrefixRouter()
+        self.router_lock = threading.Lock()
+
         # Signal to send information back to the GUI
         self.gui_signal = signal
 
@@ -30,32 +286,113 @@ class PluginManager:
         # Maximum number of works that the executor can use
         self.max_workers = int(config["Plugins"]["max_workers"])
 
-        # UNUSED
-        self.use_threads = "threads"  # Hardcoding, TODO: I'll do this functionality later!
-
-        # Prevent plugins from using too many threads
-        self.plugin_blame = {}
+        # Plugins are run by threads, except for these which get their own process (by name)
+        self.use_threads = "threads"
+        self.process_plugins = {
+            name.strip() for name in config["Plugins"].get("process_plugins", "").split(",") if name.strip()
+        }
 
-        # Maximum blame any single plugin can have
+        # Maximum blame (events waiting) any single plugin can have
         self.max_blame = int(self.config["Plugins"]["max_blame"])
 
         # What to do when there's too much blame
         self.blame_action = self.config["Plugins"]["blame_action"]
-        self.blame_queues = {}
+
+        # Events waiting for each plugin, key is the name of the plugin
+        self.queues = {}
+        self.queue_size = self.config["Plugins"].getint("queue_size", 1000)
+        self.overflow_policy = self.config["Plugins"].get("overflow_policy", "drop-oldest")
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow_policy `{self.overflow_policy}`, use one of {OVERFLOW_POLICIES}")
+
+        # Plugins are imported on this many threads at once
+        self.load_workers = self.config["Plugins"].getint("load_workers", 4)
+
+        # Remembers what was found in each plugin directory, so unchanged plugins aren't scanned again
+        self.discovery_cache = os.path.expanduser(self.config["Plugins"].get("discovery_cache", ""))
+
+        # Each plugin's config.json, read while it's loaded
+        self.plugin_configs = {}
+
+        # True if queuing an event can wait for a plugin to catch up
+        self.may_block = self.blame_action == "buffer" and self.overflow_policy == "block"
+
+        # The most events a worker runs for one plugin before giving other plugins a turn
+        self.drain_batch = self.config["Plugins"].getint("drain_batch", 64)
 
         # Execute plugins in paralel
         self.executor = cf.ThreadPoolExecutor(max_workers=self.max_workers)
 
+        # Event loop async plugins run on, see `attach_event_loop`
+        self.loop = None
+        self.loop_thread = None  # Only set if we had to start the loop ourselves
+
+        # Names of plugins that have at least one `async def` event method
+        self.async_plugins = set()
+
+        # For each async plugin, limits how many of it's events run at once, and the ones running
+        self.semaphores = {}
+        self.running_tasks = {}
+
+        # When each plugin's `event_main` is due
+        self.ticks = TickScheduler()
+
+        # Lets plugins send things to each other
+        self.bus = notifybus.NotificationBus(
+            self,
+            queue_size=self.config["Plugins"].getint("notify_queue_size", 100),
+            batch_size=self.config["Plugins"].getint("notify_batch_size", 32)
+        )
+
+        # Plugin name -> the short name used in metrics (it's directory)
+        self.metric_names = {}
+
+        # (plugin name, function name) -> (events counter, errors counter, time histogram)
+        self.event_metrics = {}
+
+        metrics.REGISTRY.callback(
+            "streamutils_plugin_queue_depth", "Events waiting for each plugin", "gauge", ("plugin",),
+            lambda: [((self.metric_names[name],), len(queue)) for name, queue in list(self.queues.items())]
+        )
+        metrics.REGISTRY.callback(
+            "streamutils_plugin_dropped_total", "Events thrown away because a plugin's queue was full", "counter", ("plugin",),
+            lambda: [((self.metric_names[name],), queue.dropped) for name, queue in list(self.queues.items())]
+        )
+
         self.logger = logger
 
         self.logger.info(f"Plugin directory path is: {plugin_dir}")
         self.logger.info(f"concurent.futures has spawned a {self.use_threads}-based executor with {self.max_workers} workers.")
+        if self.process_plugins:
+            self.logger.info(f"These plugins will run in their own process: {self.process_plugins}")
+
+    def create_queue(self) -> PluginEventQueue:
+        '''
+        Create an event queue for a plugin, sized by `blame_action`
+        '''
+        if self.blame_action == "discard":
+            # Don't send new events to a plugin that already has too many waiting
+            return PluginEventQueue(maxlen=self.max_blame, policy="drop-newest")
+
+        if self.blame_action == "buffer":
+            # Keep events waiting until the plugin can take them
+            return PluginEventQueue(maxlen=self.queue_size, policy=self.overflow_policy)
+
+        # ignore, no limit at all
+        return PluginEventQueue()
+
+    def get_blame(self, plugin_name) -> int:
+        '''
+        Returns the number of events waiting for a plugin
+        '''
+        return len(self.queues[plugin_name])
 
     def is_plugin_enabled(self, plugin_name):
         '''
-        Returns True is a plugin is enabled in the config and False if it is not
+        Returns True is a plugin is enabled in the config and False if it is not.
+        Plugins that aren't in the config at all are enabled
         '''
-        return self.config["Plugins.enable"].getboolean(plugin_name)
+        return self.config["Plugins.enable"].getboolean(plugin_name, True)
     
     def is_file_plugin(self, filename):
         '''
@@ -75,9 +412,48 @@ class PluginManager:
         else:
             return False
 
+    def discover_plugins(self) -> list:
+        '''
+        Returns the directories in the plugin directory that have an enabled plugin in them
+        '''
+        plugin_dirs = []
+        for directory in sorted(os.listdir(self.plugin_dir)):
+            path = os.path.join(self.plugin_dir, directory)
+            self.logger.info(f"Searching for dirs... {directory}, {path}")
+
+            if directory == "__pycache__" or not os.path.isdir(path):
+                continue
+
+            # Checked before it's imported, so disabled plugins cost nothing
+            if not self.is_plugin_enabled(directory):
+                self.logger.info(f"Skipping {path}, it's disabled in [Plugins.enable]")
+                continue
+
+            if not os.path.isfile(os.path.join(path, "main.py")):
+                self.logger.info(f"Skipping {path}, it doesn't have a main.py")
+                continue
+
+            plugin_dirs.append(path)
+
+        return plugin_dirs
+
+    def read_discovery_cache(self) -> dict:
+        '''
+        Returns what was found in each plugin directory last time, key is the directory's absolute path
+        '''
+        if not self.discovery_cache:
+            return {}
+        return cachefile.read(self.discovery_cache, DISCOVERY_CACHE_VERSION, "plugins", self.logger, "plugin discovery cache")
+
+    def write_discovery_cache(self, plugins:dict):
+        if not self.discovery_cache:
+            return
+        cachefile.write(self.discovery_cache, DISCOVERY_CACHE_VERSION, "plugins", plugins, self.logger, "plugin discovery cache")
+
     def load_plugins(self):
         '''
-        Load all valid plugins from the plugin directory
+        Load all valid plugins from the plugin directory.
+        Plugins are imported in parallel, then added one at a time in the order they were found
         '''
         self.logger.info("START: Loading plugins...")
         if not os.path.exists(self.plugin_dir):
@@ -87,25 +463,26 @@ class PluginManager:
         if not os.path.isdir(self.plugin_dir):
             self.logger.error("END: Plugin directory path is not a directory?")
             return
-        
-        # Loop through all the plugins
-        plugin_dirs = []
-        for directory in os.listdir(self.plugin_dir):
-            path = os.path.join(self.plugin_dir, directory)
-            self.logger.info(f"Searching for dirs... {directory}, {path}")
 
-            if path.find("__pycache__") == -1:
-                plugin_dirs.append(path)
-        
-        self.logger.info(f"Directories to search: {plugin_dirs}")
-        for path in plugin_dirs:
-            if path.find("__pycache__") != -1:
-                self.logger.info(f"Skipping {path}...")
-                continue
+        plugin_dirs = self.discover_plugins()
+        self.logger.info(f"Directories to load: {plugin_dirs}")
+        if not plugin_dirs:
+            return
+
+        cache = self.read_discovery_cache()
+        keys = [os.path.abspath(path) for path in plugin_dirs]
 
-            self.logger.info(f"Scanning {path}...")
-            self.load_plugin(path)
-            self.logger.info(f"{path} is loaded")
+        workers = max(1, min(self.load_workers, len(plugin_dirs)))
+        with cf.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plugin-loader") as loader:
+            results = list(loader.map(lambda path, key: self.import_plugin(path, cache.get(key)), plugin_dirs, keys))
+
+        for path, key, (plugin_name, o, plugin_path, json_path, entry) in zip(plugin_dirs, keys, results):
+            cache[key] = entry
+            if o is not None:
+                self.add_plugin(path, plugin_name, o, plugin_path, json_path, entry.get("config"))
+                self.logger.info(f"{path} is loaded")
+
+        self.write_discovery_cache(cache)
 
     def is_plugin_valid(self, obj):
         '''
@@ -116,32 +493,186 @@ class PluginManager:
         else:
             return False
     
-    def plugin_done_function(self, future:cf.Future, name:str):
+    def plugin_drain(self, plugin_name:str):
         '''
-        Required to manage blame.
-        Runs when a given plugin is done executing
+        Runs on the executor, runs events from a plugin's queue in order.
+        After `drain_batch` events it goes to the back of the line so other plugins get a turn
         '''
-        self.logger.debug(f"END: Call to plugin {name} complete (future {future}, {id(future)})")
-        self.plugin_blame[name] -= 1
-        self.logger.debug(f"{name}'s blame is {self.plugin_blame[name]} (max {self.max_blame})")
-    
-    def plugin_run_function(self, plugin_name:str, function_name:str, args:tuple=()):
+        queue = self.queues[plugin_name]
+        for _ in range(self.drain_batch):
+            event = queue.take()
+            if event is None:
+                return  # Nothing left, `put` will start a new worker for the next event
+
+            self.run_event(plugin_name, *event)
+
+        self.schedule_drain(plugin_name)
+
+    def get_event_metrics(self, plugin_name:str, function_name:str) -> tuple:
         '''
-        Run a given function from a plugin
+        Returns the (events, errors, time) metrics for one plugin's function
+        '''
+        key = (plugin_name, function_name)
+        found = self.event_metrics.get(key)
+        if found is None:
+            labels = (self.metric_names.get(plugin_name, plugin_name), function_name)
+            found = (PLUGIN_EVENTS.labels(*labels), PLUGIN_ERRORS.labels(*labels), PLUGIN_EVENT_SECONDS.labels(*labels))
+            self.event_metrics[key] = found
+        return found
+
+    def traced_ids(self, function_name:str, args:tuple) -> list:
+        '''
+        Returns the IDs of the sampled messages an event is for, see `tracing.sampled`
+        '''
+        if function_name == "event_message":
+            return [args[0].id] if tracing.sampled(args[0].id) else []
+        if function_name == "event_messages":
+            return [m.id for m in args[0] if tracing.sampled(m.id)]
+        return []
+
+    def trace_event(self, plugin_name:str, function_name:str, args:tuple, start:int, end:int):
+        ids = self.traced_ids(function_name, args)
+        if ids:
+            tracing.complete(f"{self.metric_names.get(plugin_name, plugin_name)}.{function_name}", "plugin", start, end, {"ids": ids})
+
+    def run_event(self, plugin_name:str, function_name:str, function, args:tuple):
+        '''
+        Run one event from a plugin's queue, logging anything it raises
+        '''
+        events, errors, seconds = self.get_event_metrics(plugin_name, function_name)
+        self.logger.debug(f"START: Call to plugin {plugin_name}.{function_name}")
+        start = time.perf_counter_ns()
+        try:
+            function(*args)
+        except Exception as e:
+            errors.inc()
+            self.logger.error(f"Plugin `{plugin_name}`: {function_name} caused an exception ({e!r})")
+        end = time.perf_counter_ns()
+        seconds.observe((end - start) / 1e9)
+        events.inc()
+        if tracing.enabled:
+            self.trace_event(plugin_name, function_name, args, start, end)
+        self.logger.debug(f"END: Call to plugin {plugin_name}.{function_name} complete, blame is {len(self.queues[plugin_name])}")
+
+    async def run_event_async(self, plugin_name:str, function_name:str, function, args:tuple):
+        '''
+        The same as `run_event`, for `async def` event methods
+        '''
+        events, errors, seconds = self.get_event_metrics(plugin_name, function_name)
+        self.logger.debug(f"START: Call to plugin {plugin_name}.{function_name}")
+        start = time.perf_counter_ns()
+        try:
+            await function(*args)
+        except Exception as e:
+            errors.inc()
+            self.logger.error(f"Plugin `{plugin_name}`: {function_name} caused an exception ({e!r})")
+        finally:
+            self.semaphores[plugin_name].release()
+        end = time.perf_counter_ns()
+        seconds.observe((end - start) / 1e9)
+        events.inc()
+        if tracing.enabled:
+            self.trace_event(plugin_name, function_name, args, start, end)
+        self.logger.debug(f"END: Call to plugin {plugin_name}.{function_name} complete, blame is {len(self.queues[plugin_name])}")
+
+    async def plugin_drain_async(self, plugin_name:str):
+        '''
+        Runs on the event loop, runs events from an async plugin's queue in order.
+        Async events are started as tasks, up to the plugin's `max_concurrency` at once.
+        Normal events still run on the executor, after every async event before them finishes
+        '''
+        queue = self.queues[plugin_name]
+        semaphore = self.semaphores[plugin_name]
+        running = self.running_tasks[plugin_name]
+        loop = asyncio.get_running_loop()
+
+        while True:
+            for _ in range(self.drain_batch):
+                event = queue.take()
+                if event is None:
+                    return  # Nothing left, `put` will start a new drain for the next event
+
+                function_name, function, args = event
+
+                if inspect.iscoroutinefunction(function):
+                    await semaphore.acquire()
+                    task = loop.create_task(self.run_event_async(plugin_name, function_name, function, args))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                    continue
+
+                if running:
+                    await asyncio.wait(tuple(running))  # Keep it in order with the async events
+
+                try:
+                    await loop.run_in_executor(self.executor, self.run_event, plugin_name, function_name, function, args)
+                except RuntimeError:
+                    self.logger.info(f"Not running the rest of {plugin_name}'s events, the executor is shut down")
+                    queue.close()
+                    return
+
+            await asyncio.sleep(0)  # Give everything else on the loop a turn
+
+    def schedule_drain(self, plugin_name:str):
+        '''
+        Start a worker running a plugin's queue
+        '''
+        try:
+            if plugin_name in self.async_plugins:
+                asyncio.run_coroutine_threadsafe(self.plugin_drain_async(plugin_name), self.loop)
+            else:
+                self.executor.submit(self.plugin_drain, plugin_name)
+        except RuntimeError:
+            # The executor (or event loop) was shut down while we were running
+            self.logger.info(f"Not running the rest of {plugin_name}'s events, the executor is shut down")
+            self.queues[plugin_name].close()
+
+    def attach_event_loop(self, loop):
+        '''
+        Run async plugins on `loop` (ChatWorker's loop in the asyncio backend).
+        Must be called before plugins are loaded
+        '''
+        self.loop = loop
+
+    def get_event_loop(self):
+        '''
+        Returns the event loop async plugins run on.
+        If nothing was attached (the thread backend), one is started on it's own thread
+        '''
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, name="plugin-loop", daemon=True)
+            self.loop_thread.start()
+            self.logger.info("Started an event loop for async plugins")
+
+        return self.loop
+
+    def run_coroutine(self, coroutine):
+        '''
+        Run a coroutine on the plugin event loop from any thread and wait for it
+        '''
+        loop = self.loop
+        if loop is None or not loop.is_running():
+            return asyncio.run(coroutine)
+
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result(KILL_TIMEOUT)
+
+    def get_plugin_function(self, plugin_name:str, function_name:str):
+        '''
+        Returns a function from a plugin, or None if it can't be called
         '''
-        self.logger.debug(f"START: Calling plugin function call: {plugin_name}.{function_name} {args}...")
         # Ensure the executor is still alive and hasn't terminated
         if self.executor._shutdown:
             self.logger.error(f"END: Attempted to start a new task on {self.use_threads}-based executor after it's shutdown! Ignoring request.")
             self.logger.info("^^^ The above error is normal while the application is shutting down")
-            return
+            return None
 
         # Get the plugin's object
         plugin = self.plugins.get(plugin_name)
         if plugin is None:
             # Ensure what we recived was actually valid
-            self.logger.error(f"END: Error calling into plugin: {plugin_name}.{function_name} {args}. `{plugin_name}` is not in `plugins` ({e})")
-            return
+            self.logger.error(f"END: Error calling into plugin: {plugin_name}.{function_name}. `{plugin_name}` is not in `plugins`")
+            return None
 
         # Try to get the function
         try:
@@ -149,105 +680,283 @@ class PluginManager:
             # We succeed here
         except AttributeError as e:
             # That attribute doesn't exist
-            self.logger.error(f"END: Error calling into plugin: {plugin_name}.{function_name} {args}. Can't retrive function `{function_name}` ({e})")
-            return
+            self.logger.error(f"END: Error calling into plugin: {plugin_name}.{function_name}. Can't retrive function `{function_name}` ({e})")
+            return None
 
         # Make sure that it's actually a function that we can call
         if not isinstance(function, types.MethodType):
             # If it's not, print an error and return
-            self.logger.error(f"END: Error calling into plugin: {plugin_name}.{function_name} {args}. Attribute is not of `MethodType`")
-            return
-        
-        # Get the number of threads, warn the user if there are too many
-        num_threads = len(self.executor._threads)
-        if num_threads == self.max_workers:
-            self.logger.warning(f"There are too many threads running ({num_threads}/{self.max_workers})! Tasks will be queued.")
-        
-        # Get the plugin's blame, if it's blame is too high we execuete this
-        if self.plugin_blame[plugin_name] >= self.max_blame:
-
-            # Discard the event and never send it to the plugin
-            if self.blame_action == "discard":
-                self.logger.warning(f"Plugin `{plugin_name}`: blame is too high! Discarding event")
-                return
-            
-            if self.blame_action == "buffer":
-                self.blame_queues[plugin_name].append([function_name, args])
-                self.logger.debug(f"Plugin `{plugin_name}`: blame is too high! Buffer... {self.blame_queues[plugin_name]}")
-                if len(self.blame_queues[plugin_name]) >= 1:
-                    nxt = self.blame_queues[plugin_name].pop()
-                    future = self.executor.submit(nxt[0], nxt[1])
-                    self.logger.debug(f"Executing {nxt} from buffer {self.blame_queues[plugin_name]}.")
-
-        # We're ready to submit a task after... A lot of checks.
-        future = self.executor.submit(function, args)
-        future.add_done_callback(lambda future: self.plugin_done_function(future, plugin_name))
-
-        self.logger.debug(f"There are now {num_threads} running out of {self.max_workers}")  # A little bit of debug
-
-        # Add one to the blame
-        self.plugin_blame[plugin_name] += 1
-        self.logger.debug(f"{plugin_name}'s blame is {self.plugin_blame[plugin_name]} (max {self.max_blame})")  # Debugging
+            self.logger.error(f"END: Error calling into plugin: {plugin_name}.{function_name}. Attribute is not of `MethodType`")
+            return None
+
+        return function
+
+    def queue_event(self, plugin_name:str, function_name:str, function, args:tuple, coalesce:bool=False):
+        '''
+        Add a call to a plugin's queue, starting a worker for it if needed.
+        With `coalesce` it's skipped if the same function is already waiting (see `PluginEventQueue.put`)
+        '''
+        queue = self.queues[plugin_name]
+        dropped = queue.dropped
+        if queue.put((function_name, function, args), coalesce):
+            self.schedule_drain(plugin_name)
+
+        if queue.dropped != dropped and (dropped == 0 or queue.dropped % 1000 == 0):
+            # Only warn once in a while, this can happen thousands of times a second
+            self.logger.warning(f"Plugin `{plugin_name}`: blame is too high! Dropped an event ({queue.dropped} so far)")
+
+        self.logger.debug(f"{plugin_name}'s blame is {len(queue)} (max {queue.maxlen})")  # Debugging
+
+    def plugin_run_function(self, plugin_name:str, function_name:str, args:tuple=()):
+        '''
+        Run a given function from a plugin, `args` is a tuple of arguments for it.
+        The call is added to the plugin's queue and runs after everything sent to it before
+        '''
+        self.logger.debug(f"START: Calling plugin function call: {plugin_name}.{function_name} {args}...")
+        function = self.get_plugin_function(plugin_name, function_name)
+        if function is not None:
+            self.queue_event(plugin_name, function_name, function, args)
+
+    def run_ticks(self, t:int, loop_wait:int):
+        '''
+        Queue `event_main` for every plugin that's due.
+        A plugin that still hasn't run it's last `event_main` doesn't get another one
+        '''
+        for name in self.ticks.due(time.monotonic_ns()):
+            function = self.get_plugin_function(name, "event_main")
+            if function is not None:
+                self.queue_event(name, "event_main", function, (t, loop_wait), coalesce=True)
+
+    def is_plugin_batched(self, plugin):
+        '''
+        Returns True if a plugin implements `event_messages` itself
+        '''
+        return type(plugin).event_messages is not pluginsdk.PluginInterface.event_messages
+
+    def is_plugin_async(self, plugin):
+        '''
+        Returns True if any of a plugin's event methods are `async def`
+        '''
+        return any(inspect.iscoroutinefunction(getattr(plugin, name, None)) for name in ASYNC_EVENTS)
+
+    def is_plugin_notify_batched(self, plugin):
+        '''
+        Returns True if a plugin implements `event_notifications` itself
+        '''
+        return type(plugin).event_notifications is not pluginsdk.PluginInterface.event_notifications
+
+    def has_match_function(self, plugin):
+        '''
+        Returns True if a plugin implements `match_message` itself
+        '''
+        return type(plugin).match_message is not pluginsdk.PluginInterface.match_message
+
+    def update_routes(self, plugin_name:str):
+        '''
+        Ask a plugin which messages it wants and rebuild the router.
+        Runs from the plugin's own queue, right after it's configured
+        '''
+        prefixes = self.plugins[plugin_name].message_prefixes()
+        self.logger.info(f"Plugin `{plugin_name}` wants messages starting with: {'everything' if prefixes is None else prefixes}")
+
+        with self.router_lock:
+            self.plugin_prefixes[plugin_name] = prefixes
+
+            router = PrefixRouter()
+            for name, prefixes in self.plugin_prefixes.items():
+                plugin = self.plugins[name]
+                if self.has_match_function(plugin):
+                    router.add_predicate(name, plugin.match_message)
+
+                for prefix in prefixes or ():
+                    router.add_prefix(name, prefix)
+
+            # Swapped in all at once, dispatch_messages never sees half a router
+            self.router = router
+
+    def is_command(self, text:str) -> bool:
+        '''
+        Returns True if a plugin asked for messages starting like `text` (like `!vote a`)
+        '''
+        return bool(self.router.match(text))
+
+    def dispatch_messages(self, messages:tuple):
+        '''
+        Send every message from one chat poll to every plugin that wants it.
+        Plugins that implement `event_messages` get one event for all of them, the rest get
+        one `event_message` per message
+        '''
+        router = self.router
+        routed = router.route(messages) if router.routed_plugins else {}
+
+        for name in self.plugins:
+            if name in router.routed_plugins:
+                wanted = routed.get(name)
+                if not wanted:
+                    continue  # Nothing this plugin cares about
+            else:
+                wanted = messages
+
+            if name in self.batched_plugins:
+                self.plugin_run_function(name, "event_messages", (tuple(wanted),))
+                continue
+
+            # Only look the function up once for the whole poll
+            function = self.get_plugin_function(name, "event_message")
+            if function is None:
+                continue
+
+            for message in wanted:
+                self.queue_event(name, "event_message", function, (message,))
 
     def load_plugin(self, path, filename=None, config=None):
         '''
         Load a given plugin from a filename
         '''
+        plugin_name, o, plugin_path, json_path, entry = self.import_plugin(path, filename=filename)
+        if o is not None:
+            self.add_plugin(path, plugin_name, o, plugin_path, json_path, entry.get("config"))
+
+    def import_plugin(self, path, cached=None, filename=None):
+        '''
+        Import a plugin and create it's object, without adding it to the plugins.
+        This runs on the loader threads, so it doesn't change anything in the plugin manager.
+        `cached` is what the discovery cache has for this directory (or None).
+        Returns (plugin name, plugin object or None, plugin path, JSON path, new cache entry)
+        '''
         self.logger.info(f"START: Load {filename}")
 
         if filename is None:
             filename = "main.py"
 
-        if config is None:
-            json_path = os.path.join(path, "config.json")
-
+        json_path = os.path.join(path, "config.json")
         plugin_path = os.path.join(path, filename)
         plugin_name = plugin_path
 
         self.logger.info(f"path={plugin_path}, name={plugin_name}, json={json_path}")
-        
-        # Load the plugin's spec from the path
-        self.logger.info(f"Generating and loading spec for {filename}...")
-        spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
 
-        # Create a module from that spec
-        plugin_module = importlib.util.module_from_spec(spec)
+        # Anything cached about a file is only used if the file hasn't changed since
+        entry = {"main_mtime": mtime_ns(plugin_path), "json_mtime": mtime_ns(json_path)}
+        cached = cached or {}
+        main_unchanged = cached.get("main_mtime") == entry["main_mtime"] and "class" in cached
 
-        # Load that module to create it's attributes
-        self.logger.info(f"Executing module {filename}...")
-        spec.loader.exec_module(plugin_module)
-        
-        # Look at only the first member found
-        members =  inspect.getmembers(plugin_module)
+        def loaded(o):
+            # Read it's config.json now too, instead of one at a time in configure_plugins
+            if cached.get("json_mtime") == entry["json_mtime"] and "config" in cached:
+                entry["config"] = cached["config"]
+            else:
+                try:
+                    with open(json_path, "r") as f:
+                        entry["config"] = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.logger.error(f"Can't read {json_path} ({e})")  # configure_plugin will try again
 
-        # Initalize it's blame to 0
-        self.plugin_blame[plugin_name] = 1
-        self.blame_queues[plugin_name] = []
+            return plugin_name, o, plugin_path, json_path, entry
 
-        for name, obj in members:
-            if self.is_plugin_valid(obj):
-                try:
-                    o = obj()
-
-                    # Create some special variables to hold info about this plugin
-                    o.__name__ = plugin_name
-                    o.__file__ = plugin_path
-                    o.__json__ = json_path
-                    o.__signal__ = self.gui_signal
-                    self.logger.info(f"Loaded plugin name={o.__name__} file={o.__file__} json={o.__json__}")
-
-                    # Add it to the plugins
-                    self.plugins[plugin_name] = o
-                    self.logger.info(f"{plugin_name}: Calling into event_load")
-
-                    # Run it's load function
-                    logger = logging.getLogger(f"plugins.{plugin_name}")
-                    self.plugin_run_function(plugin_name, "event_load", (logger))
-                except Exception as e:
-                    # Just skip loading it if the plugin errors
-                    self.logger.error(f"Error loading plugin {plugin_name}, caught exception: {e}")
-                    self.gui_signal.emit(f"Error loading plugin {plugin_name}, caught exception: {e}")  # Notify the user
-                    continue
+        def failed(e):
+            # Just skip loading it if the plugin errors
+            self.logger.error(f"Error loading plugin {plugin_name}, caught exception: {e}")
+            self.gui_signal.emit(f"Error loading plugin {plugin_name}, caught exception: {e}")  # Notify the user
+            entry.pop("class", None)  # Look at it properly next time
+            return plugin_name, None, plugin_path, json_path, entry
+
+        # Plugins that run in their own process are imported over there instead
+        if os.path.basename(os.path.normpath(path)) in self.process_plugins:
+            self.logger.info(f"Starting a process for {plugin_name}...")
+            try:
+                import pluginproc  # Pulls in multiprocessing, only needed for process plugins
+
+                o = pluginproc.ProcessPluginProxy(plugin_name, plugin_path, json_path)
+            except Exception as e:
+                return failed(e)
+            return loaded(o)
+
+        if main_unchanged and cached["class"] is None:
+            self.logger.info(f"Skipping {plugin_path}, it didn't have a plugin last time and hasn't changed")
+            entry["class"] = None
+            return plugin_name, None, plugin_path, json_path, entry
+
+        try:
+            # Load the plugin's spec from the path
+            self.logger.info(f"Generating and loading spec for {filename}...")
+            spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
+
+            # Create a module from that spec
+            plugin_module = importlib.util.module_from_spec(spec)
+
+            # Load that module to create it's attributes
+            self.logger.info(f"Executing module {filename}...")
+            spec.loader.exec_module(plugin_module)
+        except Exception as e:
+            return failed(e)
+
+        # Use the class found last time if the file hasn't changed, otherwise look at every member
+        cls = getattr(plugin_module, cached["class"], None) if main_unchanged else None
+        if not self.is_plugin_valid(cls):
+            cls = next((obj for _, obj in inspect.getmembers(plugin_module) if self.is_plugin_valid(obj)), None)
+
+        entry["class"] = None if cls is None else cls.__name__
+        if cls is None:
+            self.logger.warning(f"{plugin_path} doesn't have a plugin in it")
+            return plugin_name, None, plugin_path, json_path, entry
+
+        try:
+            o = cls()
+        except Exception as e:
+            return failed(e)
+
+        return loaded(o)
+
+    def add_plugin(self, path, plugin_name, o, plugin_path, json_path, config=None):
+        '''
+        Give a plugin it's queue and register it, `config` is it's config.json if it was already read
+        '''
+        # Give it an empty queue
+        self.metric_names[plugin_name] = os.path.basename(os.path.normpath(path))
+        self.queues[plugin_name] = self.create_queue()
+
+        if config is not None:
+            self.plugin_configs[plugin_name] = config
+
+        try:
+            self.register_plugin(plugin_name, o, plugin_path, json_path)
+        except Exception as e:
+            self.logger.error(f"Error loading plugin {plugin_name}, caught exception: {e}")
+            self.gui_signal.emit(f"Error loading plugin {plugin_name}, caught exception: {e}")  # Notify the user
+
+    def register_plugin(self, plugin_name, o, plugin_path, json_path):
+        '''
+        Add a newly created plugin object to the plugins and call it's `event_load`
+        '''
+        # Create some special variables to hold info about this plugin
+        o.__name__ = plugin_name
+        o.__file__ = plugin_path
+        o.__json__ = json_path
+        o.__signal__ = self.gui_signal
+        o.__bus__ = notifybus.PluginBus(self.bus, plugin_name, self.metric_names.get(plugin_name, plugin_name))
+        self.logger.info(f"Loaded plugin name={o.__name__} file={o.__file__} json={o.__json__}")
+
+        # Add it to the plugins
+        self.plugins[plugin_name] = o
+        if self.is_plugin_batched(o):
+            self.batched_plugins.add(plugin_name)
+
+        if o.tick_interval_ns is None:
+            self.logger.info(f"{plugin_name} doesn't use event_main")
+        else:
+            self.ticks.add(plugin_name, o.tick_interval_ns, time.monotonic_ns())
+
+        if self.is_plugin_async(o):
+            self.get_event_loop()
+            self.semaphores[plugin_name] = asyncio.Semaphore(max(1, o.max_concurrency))
+            self.running_tasks[plugin_name] = set()
+            self.async_plugins.add(plugin_name)
+            self.logger.info(f"{plugin_name} is async, it runs on the event loop (max_concurrency={o.max_concurrency})")
+        self.logger.info(f"{plugin_name}: Calling into event_load")
+
+        # Run it's load function
+        logger = logging.getLogger(f"plugins.{plugin_name}")
+        self.plugin_run_function(plugin_name, "event_load", (logger,))
 
     def configure_plugin(self, plugin):
         '''
@@ -258,13 +967,19 @@ class PluginManager:
         # Find the corresponding JSON file
         file = plugin.__json__
 
-        # Open the JSON and read the data
-        with open(file, "r") as f:
-            self.logger.info(f"Configuring {name}: {file}")
-            data = json.load(f)
+        # Usually it was already read while the plugin was loaded
+        data = self.plugin_configs.get(name)
+        if data is None:
+            # Open the JSON and read the data
+            with open(file, "r") as f:
+                data = json.load(f)
 
-            # Call its configure function
-            self.plugin_run_function(name, "configure", (data,))
+        # Call its configure function
+        self.logger.info(f"Configuring {name}: {file}")
+        self.plugin_run_function(name, "configure", (data,))
+
+        # Once it's configured, find out which messages it wants
+        self.queue_event(name, "message_prefixes", self.update_routes, (name,))
 
     def configure_plugins(self):
         '''
@@ -285,20 +1000,39 @@ class PluginManager:
 
         # Loop through all the plugins
         self.logger.info("Shutting down all plugins... THIS CAN TAKE A LONG TIME!")
+
+        # Throw away waiting events and let the events that are running finish first
+        for queue in self.queues.values():
+            queue.close()
+        self.executor.shutdown()
+        self.logger.info(f"Shut down executor of {self.max_workers} threads")
+
         for name, plugin in self.plugins.items():
             self.logger.info(f"Shutting down plugin {name}...")
             try:
                 # Not submitting the task here, it's important this is syncronous.
-                plugin.event_kill()
+                result = plugin.event_kill()
+                if inspect.isawaitable(result):
+                    self.run_coroutine(result)
                 self.logger.info(f"Shut down plugin {name} successfully")
             except Exception as e:
                 self.logger.error(f"While shutting down plugin {name}: event_kill method caused an exception ({e}); Skipping shutdown")
 
-        self.executor.shutdown()
-        self.logger.info(f"Shut down executor of {self.max_workers} threads")
+        if self.loop_thread is not None:
+            # We started this loop, so we stop it
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join(KILL_TIMEOUT)
+            self.logger.info("Stopped the event loop for async plugins")
+
+    def notify(self, source:str | None, dest:str, data):
+        '''
+        Send `data` to one plugin, no matter what it's subscribed to.
+        It's delivered like any other notification (with an empty topic), this doesn't wait for it
+        '''
+        self.bus.send(dest, notifybus.Notification("", source, data))
 
-    def notify(self, source:str | None, dest:str, data:str):
+    def publish(self, source:str | None, topic:str, data) -> int:
         '''
-        TODO
+        Publish a notification from outside of a plugin, see `PluginInterface.publish`
         '''
-        self.plugins[dest].event_notify(source, data)
+        return self.bus.publish(source, topic, data)
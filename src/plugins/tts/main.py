@@ -1,37 +1,455 @@
 from pluginsdk import PluginInterface
+import collections
+import subprocess
+import threading
+import hashlib
+import shutil
 import pyttsx3
+import queue
+import shlex
 import time
+import json
+import sys
+import os
+
+# What to throw away when the speech queue is full
+DROP_POLICIES = ("oldest", "newest")
+
+# Players tried (in order) when `audio_player` isn't set, `{path}` is the file to play
+AUDIO_PLAYERS = (
+    "afplay {path}",
+    "paplay {path}",
+    "aplay -q {path}",
+    "ffplay -nodisp -autoexit -loglevel quiet {path}",
+)
+
+# pyttsx3 writes AIFF on macOS and WAV everywhere else
+AUDIO_EXTENSION = ".aiff" if sys.platform == "darwin" else ".wav"
+
+class SpeechQueue:
+    """
+    Bounded queue of text waiting to be spoken, shared by the plugin thread and the speech thread.
+    """
+    def __init__(self, max_length, drop_policy):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop_policy `{drop_policy}`, use one of {DROP_POLICIES}")
+
+        self.max_length = max_length
+        self.drop_policy = drop_policy
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, text) -> bool:
+        """
+        Queue text to be spoken, returns False if something was dropped to make room (or it was).
+        """
+        with self.condition:
+            if len(self.items) >= self.max_length:
+                self.dropped += 1
+                if self.drop_policy == "newest":
+                    return False
+                self.items.popleft()
+                self.items.append(text)
+                self.condition.notify()
+                return False
+
+            self.items.append(text)
+            self.condition.notify()
+            return True
+
+    def get(self):
+        """
+        Wait for the next text, returns None once the queue is closed.
+        """
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.items.clear()
+            self.condition.notify_all()
+
+class SpamGuard:
+    """
+    Decides if a message may be spoken: each author only gets `rate_limit` messages every
+    `rate_window` seconds, and the same text isn't repeated within `duplicate_window` seconds.
+    Only used from the plugin thread, so there's no lock.
+    """
+    def __init__(self, rate_limit, rate_window, duplicate_window):
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.duplicate_window = duplicate_window
+
+        # Author ID -> times they were last spoken, oldest first
+        self.authors = {}
+
+        # Normalized text -> when it was last spoken, oldest first
+        self.recent = collections.OrderedDict()
+
+        self.next_cleanup = 0
+
+    def normalize(self, text):
+        return " ".join(text.casefold().split())
+
+    def cleanup(self, now):
+        """
+        Forget authors and text that are too old to matter, so memory stays bounded.
+        """
+        self.authors = {author: times for author, times in self.authors.items() if times and times[-1] > now - self.rate_window}
+        self.next_cleanup = now + max(self.rate_window, 1)
+
+    def allow(self, author, text, now) -> str | None:
+        """
+        Returns None if the message may be spoken, otherwise why it can't.
+        """
+        if now >= self.next_cleanup:
+            self.cleanup(now)
+
+        if self.duplicate_window > 0:
+            while self.recent and next(iter(self.recent.values())) <= now - self.duplicate_window:
+                self.recent.popitem(last=False)
+
+            key = self.normalize(text)
+            if key in self.recent:
+                return "duplicate"
+
+        if author is not None and self.rate_limit > 0:
+            times = self.authors.setdefault(author, collections.deque())
+            while times and times[0] <= now - self.rate_window:
+                times.popleft()
+            if len(times) >= self.rate_limit:
+                return "rate limited"
+            times.append(now)
+
+        if self.duplicate_window > 0:
+            self.recent[key] = now
+            self.recent.move_to_end(key)
+
+        return None
+
+class AudioCache:
+    """
+    Size-bounded directory of rendered speech, one file per text and voice settings.
+    The least recently used files are deleted first once it's over `max_bytes`.
+    """
+    def __init__(self, directory, max_bytes, logger):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.lock = threading.Lock()
+
+        # Filename -> size, least recently used first
+        self.files = collections.OrderedDict()
+        self.total = 0
+
+        # Files that are about to be played, they can't be deleted yet (filename -> count)
+        self.pinned = collections.Counter()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        """
+        Load what's already on disk, the file times say how recently each was used.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(AUDIO_EXTENSION) and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.total += size
+
+        self.logger.info(f"Audio cache has {len(self.files)} files ({self.total / 1024 / 1024:.1f} MB) in {self.directory}")
+
+    def key(self, text, voice) -> str:
+        # The same text with different voice settings is a different file
+        data = json.dumps([text, voice], sort_keys=True).encode("utf-8")
+        return hashlib.sha1(data).hexdigest() + AUDIO_EXTENSION
+
+    def path(self, name) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, name) -> str | None:
+        """
+        Path to the file if it's cached (and pins it, see `release`), otherwise None.
+        """
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+            self.pinned[name] += 1
+
+        path = self.path(name)
+        try:
+            os.utime(path)  # So it's still recent after a restart
+        except OSError:
+            # Someone deleted it
+            with self.lock:
+                self.total -= self.files.pop(name, 0)
+                self.pinned[name] -= 1
+            return None
+        return path
+
+    def put(self, name, temporary) -> str:
+        """
+        Move a freshly rendered file into the cache, pinned. Returns it's path.
+        """
+        path = self.path(name)
+        os.replace(temporary, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            self.total += size - self.files.get(name, 0)
+            self.files[name] = size
+            self.files.move_to_end(name)
+            self.pinned[name] += 1
+            evicted = self.evict()
+
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except OSError as e:
+                self.logger.warning(f"Can't delete {old} from the audio cache ({e})")
+        return path
+
+    def release(self, name):
+        """
+        The file has been played, it can be deleted again.
+        """
+        with self.lock:
+            self.pinned[name] -= 1
+            if self.pinned[name] <= 0:
+                del self.pinned[name]
+
+    def evict(self) -> list:
+        # Called with the lock held
+        evicted = []
+        for name in list(self.files):
+            if self.total <= self.max_bytes:
+                break
+            if name in self.pinned:
+                continue
+            self.total -= self.files.pop(name)
+            evicted.append(name)
+        return evicted
 
 class TTSplugin(PluginInterface):
-    def speak(self, text):
-        self.engine.say(text)
-        self.engine.runAndWait()
+    tick_interval_ns = None  # Nothing to do in event_main
 
-    def event_load(self, logger):
-        self.engine = pyttsx3.init()
+    def speak(self, text, author=None):
+        """
+        Queue text to be spoken, returns straight away. The speech thread does the speaking.
+        """
+        reason = self.guard.allow(author, text, time.monotonic())
+        if reason is not None:
+            self.logger.debug(f"Not speaking `{text}` ({reason})")
+            return
+
+        if not self.queue.put(text) and self.queue.dropped % 100 == 1:
+            # Only now and then, a raid would fill the log otherwise
+            self.logger.warning(f"Speech queue is full, dropping the {self.queue.drop_policy} messages ({self.queue.dropped} dropped so far)")
+
+    def speech_loop(self):
+        """
+        Runs on the speech thread. pyttsx3 engines aren't thread safe, so only this thread ever uses it.
+        """
+        try:
+            engine = self.start_engine()
+        except Exception as e:
+            self.logger.error(f"Can't start the TTS engine ({e!r})")
+            return
+
+        while True:
+            text = self.queue.get()
+            if text is None:
+                break
+
+            try:
+                engine.say(text)
+                engine.runAndWait()
+            except Exception as e:
+                self.logger.error(f"Can't speak `{text}` ({e!r})")
+
+        engine.stop()  # The queue was closed, stopped from here since no other thread may touch the engine
+
+    def start_engine(self):
+        """
+        Create the engine with the configured voice settings, on the thread that will use it.
+        """
+        engine = pyttsx3.init()
+        for name, value in self.voice.items():
+            engine.setProperty(name, value)
+        return engine
+
+    def voice_settings(self, engine):
+        # Everything that changes how the audio sounds, part of the audio cache key
+        return {name: engine.getProperty(name) for name in ("voice", "rate", "volume")}
+
+    def synth_loop(self):
+        """
+        Runs on the speech thread when the audio cache is on. Renders text to files (or finds
+        them in the cache) and hands them to the player thread, so the next message is
+        rendered while the current one plays.
+        """
+        try:
+            engine = self.start_engine()
+            voice = self.voice_settings(engine)
+        except Exception as e:
+            self.logger.error(f"Can't start the TTS engine ({e!r})")
+            engine = voice = None
+
+        while engine is not None:
+            text = self.queue.get()
+            if text is None:
+                break
+
+            name = self.cache.key(text, voice)
+            path = self.cache.get(name)
+            if path is None:
+                temporary = self.cache.path(f".rendering{AUDIO_EXTENSION}")  # Hidden, so `scan` skips it
+                try:
+                    engine.save_to_file(text, temporary)
+                    engine.runAndWait()
+                    if not os.path.getsize(temporary):
+                        raise OSError("the engine wrote an empty file")
+                    path = self.cache.put(name, temporary)
+                except Exception as e:
+                    self.logger.error(f"Can't render `{text}` ({e!r})")
+                    continue
+            else:
+                self.logger.debug(f"`{text}` is already rendered")
+
+            # Waits while a file is already waiting to be played, we stay one ahead at most
+            self.play_queue.put((name, path))
+
+        if engine is not None:
+            engine.stop()
+        self.play_queue.put(None)
+
+    def play_loop(self):
+        """
+        Runs on the player thread, plays rendered files one at a time.
+        """
+        while True:
+            item = self.play_queue.get()
+            if item is None:
+                break
 
+            name, path = item
+            try:
+                if not self.queue.closed:
+                    self.play_file(path)
+            except Exception as e:
+                self.logger.error(f"Can't play {path} ({e!r})")
+            finally:
+                self.cache.release(name)
+
+    def play_file(self, path):
+        if self.player is None:
+            import winsound
+            winsound.PlaySound(path, winsound.SND_FILENAME)
+            return
+
+        args = [arg.replace("{path}", path) for arg in self.player]
+        self.player_process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.player_process.wait()
+        self.player_process = None
+
+    def find_player(self, command):
+        """
+        The player command as a list of arguments, None to use winsound (Windows) and
+        False if there's no way to play audio files.
+        """
+        if command:
+            return shlex.split(command)
+        if sys.platform == "win32":
+            return None
+
+        for command in AUDIO_PLAYERS:
+            args = shlex.split(command)
+            if shutil.which(args[0]):
+                return args
+        return False
+
+    def event_load(self, logger):
         self.logger = logger
+        self.speech_thread = None
+        self.player_thread = None
+        self.player_process = None
 
     def event_message(self, m):
-        self.logger.info("Got a message")
-
-        # NO SPAM FILTER!
+        # Cheap enough to run for every message, everything slow is on the speech thread
         if m.message.startswith(self.prefix):
-            # self.tts_engine.say(m.message)
-            self.logger.info("This is a TTS message")
-            
             msg = m.message.replace(self.prefix, "", 1)
-            self.speak(msg)
+            self.speak(msg, m.author.id)
     
     def event_kill(self):
+        if self.speech_thread is not None:
+            # The speech thread finishes what it's saying, then stops the engine itself
+            self.queue.close()
+
+            player_process = self.player_process
+            if player_process is not None:
+                player_process.terminate()
+
+            self.speech_thread.join(5)
+            if self.player_thread is not None:
+                self.player_thread.join(5)
+
         self.logger.info("TTS plugin quit")
     
     def event_notify(self, source, data):
-        return
+        # Other plugins can ask us to say something, they don't count towards anyone's rate limit
+        if data.topic == "tts.say":
+            self.logger.info(f"{source} asked us to say something")
+            self.speak(str(data.payload))
     
     def event_main(self, time, loop_wait):
         return  # We don't care about what's going on this timeslice
 
     def configure(self, config):
-        self.logger.info("Plugin configured")
         self.prefix = config["prefix"]
+        self.queue = SpeechQueue(config.get("max_queue", 20), config.get("drop_policy", "oldest"))
+        self.guard = SpamGuard(
+            rate_limit=config.get("author_rate_limit", 3),
+            rate_window=config.get("author_rate_window", 60),
+            duplicate_window=config.get("duplicate_window", 30),
+        )
+
+        # Passed to the engine's setProperty, anything not set is left at the engine's default
+        self.voice = {name: config[name] for name in ("voice", "rate", "volume") if config.get(name) is not None}
+
+        speech_loop = self.speech_loop
+        if config.get("audio_cache", False):
+            self.player = self.find_player(config.get("audio_player", ""))
+            if self.player is False:
+                self.logger.error("No audio player found (set audio_player), speaking directly instead of using the audio cache")
+            else:
+                self.cache = AudioCache(
+                    os.path.expanduser(config.get("audio_cache_dir", "~/.streamutils_tts_cache")),
+                    int(config.get("audio_cache_mb", 64) * 1024 * 1024),
+                    self.logger
+                )
+                self.play_queue = queue.Queue(maxsize=1)
+                self.player_thread = threading.Thread(target=self.play_loop, name="tts-player", daemon=True)
+                self.player_thread.start()
+                speech_loop = self.synth_loop
+
+        self.speech_thread = threading.Thread(target=speech_loop, name="tts-speech", daemon=True)
+        self.speech_thread.start()
+
+        self.subscribe("tts.say")
+        self.logger.info("Plugin configured")
+
+    def message_prefixes(self):
+        return [self.prefix]
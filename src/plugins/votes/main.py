@@ -1,19 +1,94 @@
 from pluginsdk import PluginInterface
+import time
+
+class Poll:
+    """
+    One poll's options and tallies. Every vote is O(1): voters are remembered by a 64 bit
+    hash of their ID, and the options stay sorted by votes as they're counted.
+    """
+    def __init__(self, options):
+        self.options = options
+
+        # Option text (case and spaces don't matter) -> it's index
+        self.index = {self.normalize(option): i for i, option in enumerate(options)}
+
+        self.counts = [0] * len(options)
+        self.total = 0
+
+        # Option indexes, most votes first, and where each option is in it
+        self.ranking = list(range(len(options)))
+        self.position = list(range(len(options)))
+
+        # Hashes of everyone who voted. Much smaller than keeping their IDs, and with
+        # 64 bits two voters getting the same hash is about a one in a billion chance at 100k voters
+        self.voters = set()
+
+    def normalize(self, option):
+        return " ".join(option.casefold().split())
+
+    def vote(self, voter_id, option) -> str | None:
+        """
+        Count a vote, returns None if it counted, otherwise why it didn't.
+        """
+        i = self.index.get(self.normalize(option))
+        if i is None:
+            return "not an option"
+
+        voter = hash(voter_id)
+        if voter in self.voters:
+            return "already voted"
+        self.voters.add(voter)
+
+        self.counts[i] += 1
+        self.total += 1
+
+        # Move the option up past any it has overtaken, usually none or one
+        position = self.position[i]
+        while position > 0 and self.counts[self.ranking[position - 1]] < self.counts[i]:
+            above = self.ranking[position - 1]
+            self.ranking[position] = above
+            self.position[above] = position
+            position -= 1
+        self.ranking[position] = i
+        self.position[i] = position
+
+        return None
+
+    def top(self, k) -> list:
+        """
+        The `k` options with the most votes, as (option, votes) pairs.
+        """
+        return [(self.options[i], self.counts[i]) for i in self.ranking[:k]]
+
+    def winners(self) -> list:
+        """
+        Every option tied for the most votes, empty if nobody voted.
+        """
+        if self.total == 0:
+            return []
+        best = self.counts[self.ranking[0]]
+        return [self.options[i] for i in self.ranking if self.counts[i] == best]
 
 class VotePlugin(PluginInterface):
-    def event_load(self):
-        self.options = []
-        self.votes = {}
-        self.voted = []
+    # Checks once a second if the live results need updating, see `live_update_interval`
+    tick_interval_ns = 1_000_000_000
+
+    def event_load(self, logger):
+        self.logger = logger
+        self.poll = None
         self.prefix_new = ""
 
-        self.log(self.LINFO, "Voting plugin is ready")
+        # Live results are only sent when something changed, and at most every `live_update_interval` seconds
+        self.changed = False
+        self.last_update = 0
+
+        self.logger.info("Voting plugin is ready")
 
     def _check_if_auth(self, m, required):
-        if (m.author.isChatModerator or m.author.isChatOwner) and required == "mod":
+        if ("moderator" in m.author.roles or "owner" in m.author.roles) and required == "mod":
             # All moderators can preform
             return True
-        elif m.author.isChatOwner and required == "owner":
+        elif "owner" in m.author.roles and required == "owner":
             # Only the owner can preform
             return True
         elif required == "all":
@@ -21,64 +96,83 @@ class VotePlugin(PluginInterface):
             return True
         else:
             return False
+
+    def _standings(self):
+        poll = self.poll
+        parts = []
+        for option, votes in poll.top(self.live_top_k):
+            share = votes / poll.total if poll.total else 0
+            parts.append(f"{option} {votes} ({share:.0%})")
+        return f"Poll standings: {' | '.join(parts)} ({poll.total} votes)"
     
     def _handle_vote_end(self,m):
         if not self._check_if_auth(m, self.delete_poll_perms):  # Ensure user can end a vote
             return
 
-        winning_vote = max(self.votes, key=self.votes.get)
-        self.log(self.LINFO, f"Winning vote: {winning_vote}")
-        self.gui_update.emit(f"Winning vote: {winning_vote}")
+        if self.poll is None:
+            self.logger.info("No active vote to end!")
+            return
+
+        winners = self.poll.winners()
+        if not winners:
+            result = "Nobody voted"
+        elif len(winners) == 1:
+            result = f"Winning vote: {winners[0]}"
+        else:
+            result = f"Tied: {', '.join(winners)}"
+
+        self.logger.info(f"{result} ({self.poll.total} votes)")
+        self.__signal__.emit(f"{result} ({self.poll.total} votes)")
+        if winners:
+            self.publish("votes.result", winners[0])  # For anyone who wants it, like tts.say
 
-        self.options = None
-        self.votes = None
-        self.voted = None
+        self.poll = None
+        self.changed = False
 
     def _handle_vote_create(self, m):
         if not self._check_if_auth(m, self.create_poll_perms):  # Ensure user can create a vote
             return
 
-        self.log(self.LINFO, "Creating vote...")
+        self.logger.info("Creating vote...")
         options = m.message.replace(f"{self.prefix_new} ", "", 1)  # Formatting
-        options = options.split(self.option_delim)  # Split each option
+        options = [option.strip() for option in options.split(self.option_delim)]  # Split each option
+        options = [option for option in options if option]
 
-        self.options = options
-        self.votes = {option: 0 for option in self.options}
+        if not options:
+            self.logger.info("Poll has no options, not creating it")
+            return
+
+        self.poll = Poll(options)
+        self.changed = True
 
     def _handle_vote_req(self, m):
-        if self.options == None or self.votes == None:
+        if self.poll is None:
             # There's no active vote!
-            self.log(self.LINFO, "No active vote!")
+            self.logger.debug("No active vote!")
             return
         
         if not self._check_if_auth(m, self.cast_vote_perms):  # Ensure user can vote
             return
 
-        self.log(self.LINFO, "Person voted!")
         vote = m.message.replace(f"{self.prefix_vote} ", "", 1)
-        
-        if m.author.channelId in self.voted:
-            self.log(self.LINFO, "Person tried to vote twice!")
-            return
+        reason = self.poll.vote(m.author.id, vote)
+        if reason is None:
+            self.changed = True
         else:
-            try:
-                self.votes[vote] += 1
-                self.voted.append(m.author.channelId)
-            except KeyError:
-                self.log(self.LINFO, "Well that errored, they probably typed it in wrong, just gonna ignore it")
+            # Debug only, there can be thousands of these in a big poll
+            self.logger.debug(f"Ignored a vote for `{vote}` ({reason})")
     
     def event_message(self, m):
-        # self.log(self.LINFO, self.options, self.votes)
         if m.message.startswith(f"{self.prefix_new}"):
             if self._check_if_auth(m, self.create_poll_perms):
                 self._handle_vote_create(m)
             else:
-                self.log(self.LINFO, "User tried to create a poll who cannot do so")
+                self.logger.info("User tried to create a poll who cannot do so")
 
-        if m.message.startswith(f"{self.prefix_vote}"):
+        elif m.message.startswith(f"{self.prefix_vote}"):
             self._handle_vote_req(m)
         
-        if m.message.startswith(f"!endpoll"):
+        elif m.message.startswith(f"{self.prefix_end}"):
             self._handle_vote_end(m)
 
     def event_notify(self, source, data):
@@ -87,13 +181,30 @@ class VotePlugin(PluginInterface):
     def configure(self, config):
         self.prefix_new = config["prefix_new"]
         self.prefix_vote = config["prefix_vote"]
+        self.prefix_end = config.get("prefix_end", "!endpoll")
         self.option_delim = config["option_delimiter"]
         self.create_poll_perms = config["CREATE_POLL_required_perms"]  # Use "all", "mod" or "owner"
         self.cast_vote_perms = config["VOTE_required_perms"]
         self.delete_poll_perms = config["DELETE_POLL_required_perms"]
+
+        # Seconds between live results in the overlay (0 turns them off), and how many options they show
+        self.live_update_interval = config.get("live_update_interval", 5)
+        self.live_top_k = config.get("live_top_k", 3)
     
-    def event_main(self, time, loop):
-        return
+    def message_prefixes(self):
+        return [self.prefix_new, self.prefix_vote, self.prefix_end]
+
+    def event_main(self, t, loop_wait):
+        if self.poll is None or not self.changed or self.live_update_interval <= 0:
+            return
+
+        now = time.monotonic()
+        if now - self.last_update < self.live_update_interval:
+            return
+
+        self.last_update = now
+        self.changed = False
+        self.__signal__.emit(self._standings())
 
     def event_kill(self):
         pass
\ No newline at end of file
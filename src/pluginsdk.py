@@ -3,6 +3,8 @@ Module containing plugin interfaces and definitions, does not contain any plugin
 '''
 
 from abc import ABC, abstractmethod
+from messages import XMessageContainer, XAuthorContainer
+from notifybus import Notification
 
 class PluginInterface(ABC):
     '''
@@ -19,7 +21,25 @@ class PluginInterface(ABC):
     
     - __json__
         Holds the canonical path to the corresponding JSON file
+
+    - __bus__
+        The notification bus, use `publish` and `subscribe` instead of using it directly
+
+    # Async plugins
+    Any event method can be an `async def`. Plugins with at least one are run on an asyncio
+    event loop instead of a thread, so they can wait on lots of I/O at once without needing
+    a thread each. Their normal (not async) methods are still run on a thread.
     '''
+
+    # How many of this plugin's async event methods can run at the same time.
+    # 1 (the default) runs them one after the other, in order. Only change this if the
+    # plugin doesn't care what order messages are handled in
+    max_concurrency = 1
+
+    # How often `event_main` is called, in nanoseconds. 0 (the default) calls it on every
+    # poll, None never calls it. Ticks missed while the plugin was busy are merged into one
+    tick_interval_ns = 0
+
     @abstractmethod
     def event_load(self, logger):
         '''
@@ -37,30 +57,94 @@ class PluginInterface(ABC):
         pass
 
     @abstractmethod
-    def event_message(self, message):
+    def event_message(self, message: XMessageContainer):
         '''
         This method must be implemented by all plugins.
         This method will be called when a message is recived
+
+        `message` is an `XMessageContainer`, it's frozen and shared with the GUI and every
+        other plugin, so it can't be changed
         '''
         pass
 
+    def event_messages(self, messages: tuple[XMessageContainer, ...]):
+        '''
+        Plugins don't have to implement this method.
+        If a plugin implements it, it's called once per chat poll with every message from
+        that poll (in order) instead of calling `event_message` for each one
+        '''
+        for message in messages:
+            self.event_message(message)
+
+    def message_prefixes(self) -> list[str] | None:
+        '''
+        Plugins don't have to implement this method.
+        Returns the prefixes (like commands) of the messages this plugin wants, it's called
+        once, right after `configure`. The plugin then only gets messages that start with
+        one of them. None (the default) means every message
+        '''
+        return None
+
+    def match_message(self, message: XMessageContainer) -> bool:
+        '''
+        Plugins don't have to implement this method.
+        If a plugin implements it, it also gets every message this returns True for.
+        It's called on the chat thread for every message, so keep it fast and don't change
+        anything in here.
+        Plugins in `process_plugins` are different, every message is sent to their process
+        and this is called there
+        '''
+        return False
+
     @abstractmethod
-    def event_notify(self, source, data):
+    def event_notify(self, source, data: Notification):
         '''
-        Plugins may send data to others by this method.
-        It will be called when a notification happens
+        This method must be implemented by all plugins.
+        It's called with every notification published to a topic this plugin subscribed to
 
-        TODO: The method to send data isn't implemented
+        `source` is the name of the plugin that published it (None if it wasn't a plugin)
+        `data` is a `Notification`, the payload is in `data.payload` and the topic in `data.topic`
         '''
         pass
+
+    def event_notifications(self, notifications: tuple[Notification, ...]):
+        '''
+        Plugins don't have to implement this method.
+        If a plugin implements it, notifications are handed over in batches (in order) instead
+        of calling `event_notify` for each one
+        '''
+        for notification in notifications:
+            self.event_notify(notification.source, notification)
+
+    def publish(self, topic: str, payload) -> int:
+        '''
+        Send `payload` to every plugin subscribed to `topic`. It's delivered later, on each
+        subscriber's own thread, so this never waits for them. Returns the number of subscribers.
+        Payloads are shared between subscribers (and can be sent to other processes), so use
+        something that can't be changed and can be pickled, like a string or tuple
+        '''
+        return self.__bus__.publish(topic, payload)
+
+    def subscribe(self, topic: str):
+        '''
+        Start getting notifications published to `topic`, call it from `configure` or later
+        '''
+        self.__bus__.subscribe(topic)
+
+    def unsubscribe(self, topic: str):
+        '''
+        Stop getting notifications published to `topic`
+        '''
+        self.__bus__.unsubscribe(topic)
     
     @abstractmethod
     def event_main(self, t, loop_wait):
         '''
-        This is called every time chat messages are polled
+        This is called every time chat messages are polled, or every `tick_interval_ns`
 
         `t` is `time.time_ns()`, time in nanoseconds since the UINX epoch
-        `loop_wait` is `config["Backend"]["loop_wait_ns"]`, time in nanoseconds that each wait takes
+        `loop_wait` is the current wait between polls, `config["Backend"]["loop_wait_ns"]` unless
+        `[Backend] polling = adaptive`, then it changes with how busy chat is
         '''
         pass
 
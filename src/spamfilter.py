@@ -0,0 +1,205 @@
+'''
+Module for the spam filter, drops copy-paste spam and flooding before it costs anything.
+
+It runs on the raw messages from the chat source, before they're built, formatted, shown
+or sent to plugins (see `ChatWorker.handle_items`). Each message is counted twice, by it's
+text and by it's author, and dropped if either was seen too often in the last
+`window_seconds`. See `[SpamFilter]` in the config.
+
+Plugin commands (messages starting with a prefix a plugin asked for, like `!vote a`) are
+meant to be sent word for word by lots of people, so their text has it's own, higher limit.
+They're matched on the emojized text, the same text plugins are routed on.
+
+Counts are kept in count-min sketches, so memory stays the same no matter how many
+different messages or authors there are. A sketch can only overcount (never undercount),
+the config's defaults keep that small even during a raid.
+'''
+
+from array import array
+import operator
+import time
+import logging
+
+import emojicache
+import metrics
+
+SPAM_DROPPED = metrics.REGISTRY.counter("streamutils_spam_dropped_total", "Messages dropped by the spam filter", ("reason",))
+
+# Message types that are never dropped, people paid for these
+PAID_TYPES = ("superChat", "superSticker", "newSponsor", "donation")
+
+class WindowedCountMin:
+    '''
+    Count-min sketch over a sliding window of time.
+
+    The window is split into `buckets` slices, each with it's own sketch, plus a running
+    total of all of them. Counting adds to the newest slice and the total, and when a slice
+    gets too old it's subtracted from the total and reused
+    '''
+    def __init__(self, width:int, depth:int, window:float, buckets:int=6):
+        # Each row takes it's own bits from one 64 bit hash, so the width is a power of two
+        bits = max(width - 1, 1).bit_length()
+        if bits * depth > 64:
+            raise ValueError(f"A sketch {width} wide can be at most {64 // bits} deep")
+
+        self.width = 1 << bits
+        self.depth = depth
+        self.size = self.width * depth
+        self.mask = self.width - 1
+        self.rows = [(row * self.width, row * bits) for row in range(depth)]  # (where the row starts, hash bits to use)
+        self.bucket_seconds = window / buckets
+
+        # 4 byte counters, a lot smaller than lists of ints
+        self.buckets = [self.zeros() for _ in range(buckets)]
+        self.total = self.zeros()
+        self.current = 0
+        self.bucket_end = None
+
+    def zeros(self) -> array:
+        return array("I", bytes(4 * self.size))
+
+    def advance(self, now:float):
+        '''
+        Forget slices that have left the window
+        '''
+        if self.bucket_end is None:
+            self.bucket_end = now + self.bucket_seconds
+            return
+        if now < self.bucket_end:
+            return
+
+        steps = int((now - self.bucket_end) // self.bucket_seconds) + 1
+        self.bucket_end += steps * self.bucket_seconds
+
+        if steps >= len(self.buckets):
+            # Quiet for the whole window, everything is old
+            self.buckets = [self.zeros() for _ in self.buckets]
+            self.total = self.zeros()
+            return
+
+        for _ in range(steps):
+            self.current = (self.current + 1) % len(self.buckets)
+            old = self.buckets[self.current]
+            self.total = array("I", map(operator.sub, self.total, old))
+            self.buckets[self.current] = self.zeros()
+
+    def add(self, key) -> int:
+        '''
+        Count `key` once, returns about how many times it's been counted in the window
+        '''
+        h = hash(key)
+        mask = self.mask
+        total = self.total
+
+        cells = []
+        estimate = None
+        for start, shift in self.rows:
+            cell = start + (h >> shift & mask)
+            cells.append(cell)
+            count = total[cell]
+            if estimate is None or count < estimate:
+                estimate = count
+
+        # Conservative update: only the smallest cells go up, the others already count
+        # other keys too. Overcounts a lot less when the window is busy
+        bucket = self.buckets[self.current]
+        for cell in cells:
+            if total[cell] == estimate:
+                total[cell] += 1
+                bucket[cell] += 1  # So it's taken off the total again when this slice gets old
+        return estimate + 1
+
+class SpamFilter:
+    '''
+    Drops messages whose text, or author, was seen too often in the last `window_seconds`
+    '''
+    def __init__(self, config, logger=None, is_command=None):
+        self.logger = logger or logging.getLogger("spamfilter")
+        section = config["SpamFilter"]
+
+        window = section.getfloat("window_seconds", 30)
+        width = section.getint("sketch_width", 16384)
+        depth = section.getint("sketch_depth", 4)
+
+        # Each text can be sent this many times per window, 0 turns the check off
+        self.max_repeats = section.getint("max_repeats", 3)
+
+        # The same for plugin commands, 0 turns the check off
+        self.max_command_repeats = section.getint("max_command_repeats", 200)
+
+        # Each author can send this many messages per window, 0 turns the check off
+        self.max_author_messages = section.getint("max_author_messages", 10)
+
+        # Owners and moderators are never filtered
+        self.exempt_mods = section.getboolean("exempt_mods", True)
+
+        # Function of a message's (emojized) text, True if a plugin asked for it.
+        # Those are limited by `max_command_repeats` instead of `max_repeats`
+        self.is_command = is_command
+
+        self.texts = WindowedCountMin(width, depth, window)
+        self.authors = WindowedCountMin(width, depth, window)
+
+        self.logger.info(f"Spam filter on: {self.max_repeats} repeats ({self.max_command_repeats} for commands) and {self.max_author_messages} messages per author every {window} seconds")
+
+    def normalize(self, text:str) -> str:
+        # "Spam", "spam" and "spam  " are the same spam
+        return " ".join(text.casefold().split())
+
+    def filter(self, items:list, now:float|None=None) -> list:
+        '''
+        Returns the messages (from a chat source) that aren't spam, in the same order
+        '''
+        now = time.monotonic() if now is None else now
+        self.texts.advance(now)
+        self.authors.advance(now)
+
+        is_command = self.is_command
+        kept = []
+        dropped_text = 0
+        dropped_command = 0
+        dropped_author = 0
+        for c in items:
+            if c.type in PAID_TYPES:
+                kept.append(c)
+                continue
+
+            a = c.author
+            if self.exempt_mods and (a.isChatOwner or a.isChatModerator):
+                kept.append(c)
+                continue
+
+            # Both are always counted, so a flood is still seen while it's being dropped
+            command = is_command is not None and is_command(emojicache.emojize(c.message))
+            max_repeats = self.max_command_repeats if command else self.max_repeats
+            repeats = self.texts.add(self.normalize(c.message)) if max_repeats else 0
+            sent = self.authors.add(a.channelId) if self.max_author_messages else 0
+
+            if max_repeats and repeats > max_repeats:
+                if command:
+                    dropped_command += 1
+                else:
+                    dropped_text += 1
+            elif self.max_author_messages and sent > self.max_author_messages:
+                dropped_author += 1
+            else:
+                kept.append(c)
+
+        if dropped_text:
+            SPAM_DROPPED.labels("repeated_text").inc(dropped_text)
+        if dropped_command:
+            SPAM_DROPPED.labels("repeated_command").inc(dropped_command)
+        if dropped_author:
+            SPAM_DROPPED.labels("author_flood").inc(dropped_author)
+        if dropped_text or dropped_command or dropped_author:
+            self.logger.debug(f"Dropped {dropped_text} repeated, {dropped_command} repeated commands and {dropped_author} flooding messages")
+
+        return kept
+
+def create_filter(config, logger=None, is_command=None) -> SpamFilter | None:
+    '''
+    The spam filter configured in `[SpamFilter]`, or None if it's off
+    '''
+    if not config.has_section("SpamFilter") or not config["SpamFilter"].getboolean("enabled", False):
+        return None
+    return SpamFilter(config, logger, is_command)
@@ -0,0 +1,128 @@
+'''
+Module for tracing where chat messages spend their time, see `[Tracing]` in the config.
+
+Only some messages are traced (`sample_rate`), picked by their ID so that every part of the
+program agrees on which ones. The trace is written as Chrome trace-event JSON when chat
+stops, open it in chrome://tracing or https://ui.perfetto.dev
+
+When tracing is off, the only cost is checking `tracing.enabled`, so always check it before
+calling anything in here:
+
+    if tracing.enabled:
+        tracing.complete("format", "chat", start, end, {"id": m.id})
+'''
+
+import os
+import json
+import zlib
+import logging
+import threading
+import collections
+
+# Everything is off until `configure` turns it on
+enabled = False
+
+logger = logging.getLogger("tracing")
+
+# Events are added from the chat, GUI and plugin threads while `write` may be copying them
+_lock = threading.Lock()
+_events = collections.deque(maxlen=100000)
+_threshold = 0
+_output = "streamutils_trace.json"
+_pid = os.getpid()
+_named_threads = set()
+
+# Flow IDs started by `flow_start` and not finished yet, see `flow_end`
+_flows = set()
+
+def configure(config):
+    '''
+    Read `[Tracing]` from the config
+    '''
+    global enabled, _events, _threshold, _output
+    if not config.has_section("Tracing"):
+        return
+
+    section = config["Tracing"]
+    enabled = section.getboolean("enabled", False)
+    if not enabled:
+        return
+
+    sample_rate = min(max(section.getfloat("sample_rate", 0.01), 0.0), 1.0)
+    _threshold = int(sample_rate * 2**32)
+    _output = section.get("output", _output)
+    _events = collections.deque(maxlen=section.getint("max_events", 100000))
+    logger.info(f"Tracing {sample_rate:.2%} of messages to {_output}")
+
+def sampled(message_id: str) -> bool:
+    '''
+    Returns True if the message with this ID is traced
+    '''
+    return zlib.crc32(message_id.encode("utf-8")) < _threshold
+
+def _us(ns: int) -> float:
+    return ns / 1000
+
+def _tid() -> int:
+    thread = threading.current_thread()
+    tid = thread.ident
+    if tid not in _named_threads:
+        _named_threads.add(tid)
+        with _lock:
+            _events.append({"name": "thread_name", "ph": "M", "pid": _pid, "tid": tid, "args": {"name": thread.name}})
+    return tid
+
+def message_flow_id(message_id: str) -> int:
+    '''
+    A flow ID for one message, for arrows that follow a single message instead of a whole poll
+    '''
+    return zlib.crc32(message_id.encode("utf-8"))
+
+def complete(name: str, category: str, start_ns: int, end_ns: int, args: dict | None = None):
+    '''
+    Record something that ran on this thread from `start_ns` to `end_ns` (`time.perf_counter_ns()`)
+    '''
+    event = {"name": name, "cat": category, "ph": "X", "pid": _pid, "tid": _tid(), "ts": _us(start_ns), "dur": _us(end_ns - start_ns)}
+    if args:
+        event["args"] = args
+    with _lock:
+        _events.append(event)
+
+def flow_start(name: str, flow_id: int, at_ns: int):
+    '''
+    Start an arrow from this thread to wherever `flow_end` is called with the same ID,
+    like a Qt signal being sent to the GUI thread
+    '''
+    event = {"name": name, "cat": "flow", "ph": "s", "id": flow_id, "pid": _pid, "tid": _tid(), "ts": _us(at_ns)}
+    with _lock:
+        _flows.add(flow_id)
+        _events.append(event)
+
+def flow_end(name: str, flow_id: int, at_ns: int) -> bool:
+    '''
+    Finish an arrow started by `flow_start`. Returns False (and does nothing) if it wasn't started
+    '''
+    event = {"name": name, "cat": "flow", "ph": "f", "bp": "e", "id": flow_id, "pid": _pid, "tid": _tid(), "ts": _us(at_ns)}
+    with _lock:
+        if flow_id not in _flows:
+            return False
+
+        _flows.discard(flow_id)
+        _events.append(event)
+    return True
+
+def write(path: str | None = None):
+    '''
+    Write everything recorded so far as Chrome trace-event JSON
+    '''
+    if not enabled:
+        return
+
+    path = path or _output
+    with _lock:
+        events = list(_events)  # Other threads may still be tracing, the file gets what's here now
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    logger.info(f"Wrote {len(events)} trace events to {path}")
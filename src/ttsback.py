@@ -1,94 +1,152 @@
 # chat_fetcher.py
 
-import pytchat
 # import emoji
 from PyQt5.QtCore import QThread, pyqtSignal
 import plugins
-import emoji
+import chatsources
+import emojicache
+import spamfilter
+import metrics
+import tracing
 
 import os
-import importlib.resources
-import emoji
-
-# Stupid workaround for pyinstaller
-language = "en"  # Change this at build time, screw you
-with importlib.resources.path(emoji, f"unicode_codes/emoji_{language}.json") as path:
-    emoji.EMOJI_DATA = path
+import asyncio
 
 import time
 
 import logging
 
-from dataclasses import dataclass
-
-'''
-Will be used later...
-'''
-@dataclass
-class XAuthorContainer:
-   platform:            str
-   name:                str
-   id
-   url:                 str | None
-   roles:               dict[str, bool]
-   platform_specific:   dict
-        
-@dataclass
-class XMessageContainer:
-    platform:               str
-                 
-    # Cross platform stuff
-    type:                   str
-    id
-    message:                str
-    timestamp:              float
-    datetime:               str | None
-    dono_amount:            float | None
-    dono_amount_string:     str
-    dono_currency:          str
-    dono_colour:            str
-    author:                 XAuthorContainer
-
-    # Platform specifics
-    platform_specific:      dict
-
-def convert_message_for_gui(c, config) -> tuple[str, str]:
-    c.message = emoji.emojize(c.message)  # Sorry
-    verbose = config["Frontend"].getboolean("verbose", False)
-
-    if verbose:
-        gui_message = f"\n\
-            type={c.type}\n\
-            id={c.id}\n\
-            message={c.message}\n\
-            messageEx={c.messageEx}\n\
-            timestamp={c.timestamp}\n\
-            datetime={c.datetime}\n\
-            elapsedTime={c.elapsedTime}\n\
-            donoAmountValue={c.amountValue}\n\
-            donoAmountString={c.amountString}\n\
-            donoCurrency={c.currency}\n\
-            bgColour={c.bgColor}\n\
-            author.name={c.author.name}\n\
-            author.channelId={c.author.channelId}\n\
-            author.channelUrl={c.author.channelUrl}\n\
-            author.imageUrl={c.author.imageUrl}\n\
-            author.badgeUrl={c.author.badgeUrl}\n\
-            author.isVerified={c.author.isVerified}\n\
-            author.isChatOwner={c.author.isChatOwner}\n\
-            author.isChatModerator={c.author.isChatModerator}\n\
-            author.isChatSponsor={c.author.isChatSponsor}"
-
-    elif c.type == "superChat":
-        gui_message = config["Frontend.messageTemplates"]["superChat"].format(msg=c)
-
-    elif c.type == "textMessage":
-        gui_message = config["Frontend.messageTemplates"]["textMessage"].format(msg=c)
-    
-    else:
-        gui_message = "Unregognized message type, not textMessage or superChat?"
-
-    return gui_message
+from messages import XMessageContainer
+
+# Every message type pytchat can give us, config keys are lowercase so we need the real names
+MESSAGE_TYPES = ("textMessage", "superChat", "superSticker", "newSponsor", "donation")
+
+# Used for message types that don't have a template
+UNKNOWN_TEMPLATE = "Unrecognized message type `{msg.type}`, add a template for it to [Frontend.messageTemplates]"
+
+# Used for every message when [Frontend] verbose is on
+VERBOSE_TEMPLATE = "\n".join([
+    "",
+    "platform={msg.platform}",
+    "type={msg.type}",
+    "id={msg.id}",
+    "message={msg.message}",
+    "timestamp={msg.timestamp}",
+    "datetime={msg.datetime}",
+    "donoAmount={msg.dono_amount}",
+    "donoAmountString={msg.dono_amount_string}",
+    "donoCurrency={msg.dono_currency}",
+    "donoColour={msg.dono_colour}",
+    "author.name={msg.author.name}",
+    "author.id={msg.author.id}",
+    "author.url={msg.author.url}",
+    "author.imageUrl={msg.author.image_url}",
+    "author.roles={msg.author.roles}",
+    "platformSpecific={msg.platform_specific}",
+])
+
+class MessageFormatter:
+    """
+    Turns messages into text for the GUI.
+    The config is only read once, when this is created, so formatting a message is just a
+    table lookup and a `str.format`.
+    """
+    def __init__(self, config):
+        self.verbose = config["Frontend"].getboolean("verbose", False)
+
+        # Message type -> bound `format` method of it's template
+        self.formatters = {}
+        if self.verbose:
+            self.default = VERBOSE_TEMPLATE.format
+        else:
+            self.default = UNKNOWN_TEMPLATE.format
+
+            real_names = {name.lower(): name for name in MESSAGE_TYPES}
+            for name, template in config["Frontend.messageTemplates"].items():
+                self.formatters[real_names.get(name, name)] = template.format
+
+    def format(self, m: XMessageContainer) -> str:
+        formatter = self.formatters.get(m.type)
+        if formatter is None:
+            # Types not in MESSAGE_TYPES are stored lowercase
+            formatter = self.formatters.get(m.type.lower(), self.default)
+
+        try:
+            return formatter(msg=m)
+        except (AttributeError, KeyError, IndexError, ValueError) as e:
+            # Usually a template from an old config using a field that doesn't exist anymore
+            return f"Can't format {m.type} message, check it's template in [Frontend.messageTemplates] ({e!r})"
+
+POLL_BATCH_SIZE = metrics.REGISTRY.histogram("streamutils_poll_batch_size", "Messages fetched by each chat poll", buckets=metrics.SIZE_BUCKETS)
+FETCH_SECONDS = metrics.REGISTRY.histogram("streamutils_fetch_seconds", "How long each chat poll takes")
+
+# How ChatWorker decides how long to wait between polls
+POLLING_MODES = ("fixed", "adaptive")
+
+class PollInterval:
+    """
+    Decides how long ChatWorker waits between polls, in the same units as `[Backend] loop_wait_ns`.
+    With `polling = fixed` it's always `loop_wait_ns`. With `polling = adaptive` the wait is
+    halved after a busy poll and doubled after an empty one, staying between
+    `loop_wait_min_ns` and `loop_wait_max_ns`.
+    """
+    def __init__(self, config, logger):
+        self.logger = logger
+        self.mode = config["Backend"].get("polling", "fixed")
+        if self.mode not in POLLING_MODES:
+            raise ValueError(f"Unknown polling mode `{self.mode}`, use one of {POLLING_MODES}")
+
+        # The current wait
+        self.wait = config["Backend"].getint("loop_wait_ns")
+
+        self.min_wait = config["Backend"].getint("loop_wait_min_ns", self.wait)
+        self.max_wait = config["Backend"].getint("loop_wait_max_ns", self.wait)
+        if self.min_wait > self.max_wait:
+            raise ValueError(f"loop_wait_min_ns ({self.min_wait}) is bigger than loop_wait_max_ns ({self.max_wait})")
+
+        # A poll with at least this many messages is busy
+        self.busy_batch = config["Backend"].getint("busy_batch_size", 20)
+
+        if self.mode == "adaptive":
+            self.wait = self.clamp(self.wait)
+            self.logger.info(f"Adaptive polling between {self.min_wait} and {self.max_wait}, starting at {self.wait}")
+
+    def clamp(self, wait: int) -> int:
+        return min(max(wait, self.min_wait), self.max_wait)
+
+    def update(self, count: int) -> int:
+        """
+        Tell it how many messages the last poll got, returns the wait before the next poll.
+        """
+        if self.mode == "fixed":
+            return self.wait
+
+        if count >= self.busy_batch:
+            wait = self.clamp(self.wait // 2)  # Busy, poll more often
+        elif count == 0:
+            wait = self.clamp(max(self.wait * 2, 1))  # Idle, back off
+        else:
+            return self.wait  # Somewhere in between, it's fine
+
+        if wait != self.wait:
+            self.wait = wait
+            if wait in (self.min_wait, self.max_wait):
+                self.logger.info(f"Polling interval is now {wait} ({'busy' if count else 'idle'} chat)")
+            else:
+                self.logger.debug(f"Polling interval is now {wait}")
+
+        return self.wait
+
+def build_message(c) -> XMessageContainer:
+    """
+    Turn a message from the chat source into the message the GUI and plugins get.
+    This is done exactly once per message.
+    """
+    # Only messages from a MergedSource are tagged with where they came from
+    return XMessageContainer.from_pytchat(c, emojicache.emojize(c.message), getattr(c, "platform", "youtube"))
+
+def convert_message_for_gui(m: XMessageContainer, formatter: MessageFormatter) -> str:
+    return formatter.format(m)
 
 class ChatWorker(QThread):
     """
@@ -96,6 +154,7 @@ class ChatWorker(QThread):
     This class fetches messages and processes commands.
     """
     msg_signal = pyqtSignal(str)  # send messages back to the GUI
+    batch_signal = pyqtSignal(list, object, object)  # send a whole poll's worth of messages (when they were fetched, and what's traced) back to the GUI at once
 
     def __init__(self, video_id: str, config: dict):
         super().__init__()
@@ -117,46 +176,182 @@ class ChatWorker(QThread):
             config=self.config,
             logger=pluginmgr_logger
         )
-        self.loop_wait = self.config["Backend"].getint("loop_wait_ns")
+        self.poll_interval = PollInterval(self.config, self.logger)
         self.pluginmain = self.config["Plugins"].getboolean("enable_pluginmain", False)
+        self.batch_messages = self.config["Frontend"].getboolean("batch_messages", False)
+        self.formatter = MessageFormatter(self.config)
+
+        # None when [SpamFilter] is off. Plugin commands get a higher repeat limit than other text
+        self.spam_filter = spamfilter.create_filter(self.config, is_command=self.plugin_manager.is_command)
+
+        # "thread" polls chat with blocking calls, "asyncio" runs the fetch loop (and async plugins) on an event loop
+        self.backend_mode = self.config["Backend"].get("backend_mode", "thread")
+        if self.backend_mode not in ("thread", "asyncio"):
+            raise ValueError(f"Unknown backend_mode `{self.backend_mode}`, use `thread` or `asyncio`")
+        self.loop = None
+        self.main_task = None
+
+        tracing.configure(self.config)
+        self.metrics_exporter = metrics.MetricsExporter(self.config)
+        metrics.REGISTRY.callback("streamutils_poll_interval", "Current wait between chat polls (loop_wait_ns units)", "gauge", (), lambda: [((), self.loop_wait)])
 
         self.set_video_id(self.video_id)
 
+    @property
+    def loop_wait(self) -> int:
+        """
+        The current wait between polls, it changes as chat gets busier or quieter with `[Backend] polling = adaptive`.
+        """
+        return self.poll_interval.wait
+
     def startup(self):
+        self.metrics_exporter.start()
+
         # Initalize all plugins
         self.plugin_manager.load_plugins()
         self.plugin_manager.configure_plugins()
         self.msg_signal.emit("[CHAT WORKER | INFO] Dave From Seattle is READY!")
 
     def plugins_main(self):
-        for name, _ in self.plugin_manager.plugins.items():
-            t = time.time_ns()
-            self.plugin_manager.plugin_run_function(name, "event_main", (t, self.loop_wait,))
+        # Only the plugins that are due get an event_main, see PluginManager.run_ticks
+        self.plugin_manager.run_ticks(time.time_ns(), self.loop_wait)
 
-    def message_notify(self, message):
-        for name, _ in self.plugin_manager.plugins.items():
-            self.plugin_manager.plugin_run_function(name, "event_message", (message))
+    def message_notify(self, messages):
+        self.plugin_manager.dispatch_messages(tuple(messages))
 
     def run(self):
         """
         Starts the thread and continuously fetches messages from the chat.
         """
+        if self.backend_mode == "asyncio":
+            asyncio.run(self.run_async())
+        else:
+            self.run_threaded()
+
+    def run_threaded(self):
+        """
+        The thread backend, waits and polls with blocking calls.
+        """
         self.startup()
         # While running, we fetch chat messages
         while self.running:
             self.usleep(self.loop_wait)
+            if not self.running:
+                break  # Stopped while we slept, the chat may already be terminated
+
             if self.pluginmain: self.plugins_main()
-            for c in self.chat.get().sync_items():
-                # Process the message
+
+            start = time.perf_counter_ns()
+            items = self.chat.get_items()
+            fetched_at = time.perf_counter_ns()
+            FETCH_SECONDS.observe((fetched_at - start) / 1e9)
+            if not self.running:
+                self.logger.info("Running flipped from True to False, exiting...")
+                return
+
+            self.handle_items(items, start, fetched_at)
+            self.poll_interval.update(len(items))
+
+    async def run_async(self):
+        """
+        The asyncio backend, polls chat and runs async plugins on one event loop.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.plugin_manager.attach_event_loop(self.loop)
+
+        try:
+            self.startup()
+            while self.running:
+                await asyncio.sleep(self.loop_wait / 1_000_000)  # loop_wait is in microseconds, like usleep
+                if self.pluginmain: await self.call_plugins(self.plugins_main)
+
+                start = time.perf_counter_ns()
+                items = await self.chat.get_items_async()
+                fetched_at = time.perf_counter_ns()
+                FETCH_SECONDS.observe((fetched_at - start) / 1e9)
                 if not self.running:
                     self.logger.info("Running flipped from True to False, exiting...")
                     return
 
-                formatted_msg = convert_message_for_gui(c, self.config)
-                self.msg_signal.emit(formatted_msg)  # Update the GUI
+                messages = self.handle_items(items, start, fetched_at, notify=False)
+                if messages:
+                    await self.call_plugins(self.message_notify, messages)
+                self.poll_interval.update(len(items))
 
-                # Notify plugins
-                self.message_notify(c)
+        except asyncio.CancelledError:
+            self.logger.info("Chat loop was cancelled, exiting...")
+        finally:
+            self.chat.terminate()
+
+    async def call_plugins(self, function, *args):
+        """
+        Queue events for plugins from the event loop.
+        If a full queue can wait for it's plugin, this is done on a thread so the loop
+        (and any async plugins on it) keep running while we wait.
+        """
+        if self.plugin_manager.may_block:
+            await asyncio.to_thread(function, *args)
+        else:
+            function(*args)
+
+    def handle_items(self, items, started_at, fetched_at, notify=True):
+        """
+        Build, format and send every message from one poll to the GUI (and plugins when `notify` is True).
+        `started_at` and `fetched_at` are `time.perf_counter_ns()` from when the poll started
+        and finished. Returns the messages.
+        """
+        POLL_BATCH_SIZE.observe(len(items))
+
+        # Spam is dropped before anything is done with it
+        if self.spam_filter is not None and items:
+            items = self.spam_filter.filter(items)
+
+        batch = []
+        messages = []
+        traced_ids = []
+        traced_poll = False
+        for c in items:
+            traced = tracing.enabled and tracing.sampled(c.id)
+            if traced:
+                start = time.perf_counter_ns()
+
+            m = build_message(c)
+            formatted_msg = convert_message_for_gui(m, self.formatter)
+
+            if traced:
+                tracing.complete("convert_message_for_gui", "chatworker", start, time.perf_counter_ns(), {"id": m.id})
+                if not traced_poll:
+                    tracing.complete("fetch", "chatworker", started_at, fetched_at, {"count": len(items)})
+                    traced_poll = True
+
+            if self.batch_messages:
+                batch.append(formatted_msg)  # Sent all at once after the poll
+                if traced:
+                    traced_ids.append(m.id)
+            else:
+                # (flow ID, traced message IDs) for the GUI, the arrow follows this one message
+                trace = None
+                if traced:
+                    trace = (tracing.message_flow_id(m.id), (m.id,))
+                    tracing.flow_start("signal", trace[0], time.perf_counter_ns())
+                self.batch_signal.emit([formatted_msg], fetched_at, trace)  # Update the GUI
+
+            messages.append(m)
+
+        if batch:
+            # One arrow for the whole poll, every message in it was fetched at the same time
+            trace = None
+            if traced_ids:
+                trace = (fetched_at, tuple(traced_ids))
+                tracing.flow_start("signal", fetched_at, time.perf_counter_ns())
+            self.batch_signal.emit(batch, fetched_at, trace)  # Update the GUI once for the whole poll
+
+        # Notify plugins
+        if notify and messages:
+            self.message_notify(messages)
+
+        return messages
 
     def stop(self):
         """
@@ -164,6 +359,14 @@ class ChatWorker(QThread):
         """
         self.plugin_manager.unload_plugins()
         self.running = False
+        self.metrics_exporter.stop()
+        tracing.write()
+
+        if self.loop is None:
+            self.chat.terminate()
+        elif not self.loop.is_closed():
+            # The chat belongs to the event loop, it's terminated when the loop stops
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
 
     def set_video_id(self, video_id: str):
         """
@@ -171,5 +374,5 @@ class ChatWorker(QThread):
         """
         self.logger.info(f"Livestream URL set: {video_id}, restarting chat...")
         self.video_id = video_id
-        self.chat = pytchat.create(video_id=self.video_id)
+        self.chat = chatsources.create_source(self.video_id, self.config)
         self.logger.info(f"Restarted chat")
@@ -2,12 +2,12 @@
 
 import sys
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QFont
+from PyQt5.QtGui import QFont, QTextCursor
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QTextEdit, QDialog, QLineEdit, QPushButton, QLabel
 from ttsback import ChatWorker
+import metrics
+import tracing
 import configparser
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
 import time
 
 import os
@@ -41,29 +41,32 @@ CONFIG_SEARCH_ORDER = [
 logger_chatworker = logging.getLogger("ChatWorker")
 logger_frontend = logging.getLogger("Frontend")
 
-parser = argparse.ArgumentParser(
-    prog="Steamutils chat overlay (AKA. Dave From Seattle)",
-    formatter_class=argparse.RawTextHelpFormatter
-)
+FETCH_TO_RENDER_SECONDS = metrics.REGISTRY.histogram("streamutils_fetch_to_render_seconds", "Time from fetching a poll of chat to showing it in the window")
 
-parser.add_argument("video_ID", type=str, help="YouTube video ID to use (REQUIRED)", default="https://www.youtube.com/watch?v=jfKfPfyJRdk")
-parser.add_argument("-C", type=str, help="config file to use", metavar="configpath", required=False)
-parser.add_argument("--log_level", type=int, help=f"{LOG_LEVELS_LIST_TEXT}", default=20, required=False)
-parser.add_argument("--quiet", help="Don't log to stdout", action="store_true", required=False)
-
-args = parser.parse_args()
-
-print(SPLASH_TEXT)
-
-logging.basicConfig(
-    level=args.log_level,
-    format='[ %(asctime)15s | %(name)15s | %(levelname)8s ]\t %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout) if not args.quiet else logging.StreamHandler(os.devnull)
-    ]
-)
-
-configpath = args.C
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    Parse the command line, `argv` defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(
+        prog="Steamutils chat overlay (AKA. Dave From Seattle)",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    parser.add_argument("video_ID", type=str, help="YouTube video ID to use (REQUIRED)", default="https://www.youtube.com/watch?v=jfKfPfyJRdk")
+    parser.add_argument("-C", type=str, help="config file to use", metavar="configpath", required=False)
+    parser.add_argument("--log_level", type=int, help=f"{LOG_LEVELS_LIST_TEXT}", default=20, required=False)
+    parser.add_argument("--quiet", help="Don't log to stdout", action="store_true", required=False)
+
+    return parser.parse_args(argv)
+
+def setup_logging(args):
+    logging.basicConfig(
+        level=args.log_level,
+        format='[ %(asctime)15s | %(name)15s | %(levelname)8s ]\t %(message)s',
+        handlers=[
+            logging.StreamHandler(sys.stdout) if not args.quiet else logging.NullHandler()
+        ]
+    )
 
 def search_config(order) -> str | None:  # Filename
     logging.info(f"Searching for config automatically... Order: {order}")
@@ -78,26 +81,37 @@ def search_config(order) -> str | None:  # Filename
     logging.info("Can't find config")
     return None
 
-if configpath is None:
-    configpath = search_config(CONFIG_SEARCH_ORDER)
+def load_config(configpath: str | None) -> configparser.ConfigParser:
+    """
+    Read the config from `configpath`, or search for one if it's None. Exits if there isn't one.
+    """
     if configpath is None:
-        logging.info("No config file was found. Exiting with code -1...")
-        sys.exit(-1)
+        configpath = search_config(CONFIG_SEARCH_ORDER)
+        if configpath is None:
+            logging.info("No config file was found. Exiting with code -1...")
+            sys.exit(-1)
 
-logging.info(f"Config file path is: {configpath}")
-logging.info(f"Log level is: {args.log_level}")
+    logging.info(f"Config file path is: {configpath}")
 
-config = configparser.ConfigParser()
-config.read(configpath)
-logging.info(f"Read configuration {configpath}")
+    config = configparser.ConfigParser()
+    config.read(configpath)
+    logging.info(f"Read configuration {configpath}")
+    return config
+
+def get_app() -> QApplication:
+    """
+    The QApplication, there can only be one so it's created the first time it's needed.
+    """
+    return QApplication.instance() or QApplication(sys.argv)
 
 class MainWindow(QWidget):
     """
     The main Frontend window to display chat messages.
     """
-    def __init__(self, chat_worker: ChatWorker):
+    def __init__(self, chat_worker: ChatWorker, config: configparser.ConfigParser):
         super().__init__()
         self.chosen_link = None
+        self.config = config
 
         # Window setup
         self.setWindowTitle(config["Window"]["title"])  # Window title
@@ -124,6 +138,13 @@ class MainWindow(QWidget):
         # Create the chatbox for displaying chat messages
         self.chatbox = QTextEdit("", self)
 
+        # Nobody undoes chat, and the undo history would grow forever
+        self.chatbox.setUndoRedoEnabled(False)
+
+        # Throw away the oldest lines once there are too many, 0 keeps everything
+        max_messages = config["Window"].getint("max_messages", 0)
+        self.chatbox.document().setMaximumBlockCount(max_messages)
+
         if not config["Window"].getboolean("scrollbars", True):
             self.chatbox.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
             self.chatbox.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
@@ -144,6 +165,7 @@ class MainWindow(QWidget):
 
         # Assign the worker a signal
         self.worker.msg_signal.connect(self.append_message)
+        self.worker.batch_signal.connect(self.append_messages)
         self.worker.start()  # Start the worker thread to fetch chat
 
     def append_message(self, txt):
@@ -154,9 +176,41 @@ class MainWindow(QWidget):
         scrollbar = self.chatbox.verticalScrollBar()
         scrollbar.setValue(scrollbar.maximum())
 
-        if config["Frontend"].getboolean("terminal_echo", True):
+        if self.config["Frontend"].getboolean("terminal_echo", True):
             logging.info(f"Echoed to terminal: {txt}")
 
+    def append_messages(self, txts, fetched_at=None, trace=None):
+        """
+        Append a batch of chat messages in a single edit block and scroll to the bottom once.
+        `fetched_at` is `time.perf_counter_ns()` from when the messages were fetched.
+        `trace` is (flow ID, traced message IDs) if a sampled message is in this batch.
+        """
+        started = time.perf_counter_ns()
+
+        # Everything inside the edit block is laid out once, when the block ends
+        cursor = QTextCursor(self.chatbox.document())
+        cursor.beginEditBlock()
+        for txt in txts:
+            self.chatbox.append(txt)
+        cursor.endEditBlock()
+
+        scrollbar = self.chatbox.verticalScrollBar()
+        scrollbar.setValue(scrollbar.maximum())
+
+        if fetched_at is not None:
+            finished = time.perf_counter_ns()
+            FETCH_TO_RENDER_SECONDS.observe((finished - fetched_at) / 1e9)
+
+            # Only traced if a sampled message is in this batch
+            if trace is not None and tracing.enabled:
+                flow_id, ids = trace
+                tracing.flow_end("signal", flow_id, started)
+                tracing.complete("append_messages", "frontend", started, finished, {"count": len(txts), "ids": list(ids)})
+
+        if self.config["Frontend"].getboolean("terminal_echo", True):
+            for txt in txts:
+                logging.info(f"Echoed to terminal: {txt}")
+
     def closeEvent(self, event):
         """
         Handle window close event. Safely stop the worker thread.
@@ -206,14 +260,14 @@ class PopupDialog(QDialog):
     def on_cancel(self):
         sys.exit(1)
 
-def entrypoint(video_id):
+def entrypoint(video_id, config):
     console_title = config["Window"].get("console_title", fallback="Dave From Seattle (CONSOLE)")
     print(f"\33]0;{console_title}\a", end="", flush=True)
 
-    app = QApplication(sys.argv)
+    app = get_app()
 
     chat_worker = ChatWorker(video_id, config)
-    main_window = MainWindow(chat_worker)
+    main_window = MainWindow(chat_worker, config)
     main_window.show()
 
     logging.info("This is the console window! It's not the main application, you can minimize it safely unless you need the debugging information")
@@ -222,7 +276,7 @@ def entrypoint(video_id):
     logging.fatal("The application appears to have terminated or shut down. Exiting with code 0...")
     exit(0)
 
-def run_linkui(additional_msg=None):
+def run_linkui(config, additional_msg=None):
     while True:
         dialog = linkui_dialog(additional_msg)
         if dialog.link in [None, ""]:
@@ -230,10 +284,10 @@ def run_linkui(additional_msg=None):
         else:
             break
 
-    entrypoint(dialog.link)
+    entrypoint(dialog.link, config)
 
 def linkui_dialog(additional_msg=None):
-    app = QApplication(sys.argv)
+    app = get_app()
 
     dialog = PopupDialog()
 
@@ -246,59 +300,63 @@ def linkui_dialog(additional_msg=None):
 
     return dialog
 
-def get_user_stream(channelid):
+def get_user_stream(channelid, config):
+    """
+    Returns the URL of the stream the channel is live on, or None if it isn't live.
+    """
+    # Only autofetch needs it
+    import livefetch
+
     logging.info("Autodetecting livestream URL...")
     logging.info(f"Channel ID is {channelid}")
 
-    options = webdriver.ChromeOptions()
-    options.add_argument("--headless")  # Headless mode
-    options.add_argument("--disable-gpu")
-
-    logging.info("Creating selenium instance...", end="")
-    driver = webdriver.Chrome(options=options)
-    logging.info("OK.")
-
-    url = f"https://www.youtube.com/channel/{channelid}/live"
-    driver.get(url)
-
-    logging.info("Waiting for youtube to finish loading")
-    time.sleep(1)
-
-    logging.info("Hopefully it's done.")
-    finalurl = driver.current_url
-    logging.info(f"Final URL is `{finalurl}`... ", end="")
+    resolver = livefetch.LiveResolver(config)
+    try:
+        videoid = resolver.resolve(channelid)
+    finally:
+        resolver.close()
 
-    if '/live' in finalurl:
-        # If we're still on the /live page, the user isn't live
+    if videoid is None:
         logging.error("The user is not live")
-        driver.quit()
         return None
-    else:
-        # If we're not on the /live page, the user is live and we can get the link
-        videoid = finalurl.split('v=')[1]
-        driver.quit()
-        logging.info(f"The user is live, ID: {videoid}")
-        return f"https://www.youtube.com/watch?v={videoid}"
 
-def run_autofetch():
+    logging.info(f"The user is live, ID: {videoid}")
+    return f"https://www.youtube.com/watch?v={videoid}"
+
+def run_autofetch(config):
     try: channelid = config["Startup"]["channelid"]
     except KeyError:
         logging.fatal("Attempted to run in autofetch mode, but channelid is not set. Unsure what to do. Exiting with code 2")
         sys.exit(2)
 
-    url = get_user_stream(channelid)
+    url = get_user_stream(channelid, config)
     if url is None:
-        run_linkui("Configured user isn't streaming, falling back to linkui")
+        run_linkui(config, "Configured user isn't streaming, falling back to linkui")
     
-    entrypoint(url)
+    entrypoint(url, config)
+
+def main(argv=None):
+    """
+    Parse the arguments, read the config and start in the configured startup mode.
+    Nothing here runs on import, so importing this module stays cheap.
+    """
+    args = parse_args(argv)
+
+    print(SPLASH_TEXT)
+    setup_logging(args)
+
+    config = load_config(args.C)
+    logging.info(f"Log level is: {args.log_level}")
 
-if __name__ == "__main__":
     if config["Startup"]["startup_mode"] == "linkui":
-        run_linkui()
+        run_linkui(config)
     elif config["Startup"]["startup_mode"] == "autofetch":
-        run_autofetch()
+        run_autofetch(config)
     elif config["Startup"]["startup_mode"] == "none":
-        entrypoint(args.video_ID)
+        entrypoint(args.video_ID, config)
     else:
         logging.fatal("Invalid startup mode. Unsure what to do. Exiting with code 4.")
         sys.exit(4)
+
+if __name__ == "__main__":
+    main()